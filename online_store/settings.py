@@ -19,6 +19,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'debug_toolbar',
     'rest_framework',
@@ -142,6 +143,78 @@ REDIS_HOST = os.environ.get('REDIS_HOST')
 REDIS_PORT = os.environ.get('REDIS_PORT')
 REDIS_DB = os.environ.get('REDIS_DB')
 
+# кэш в redis
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/' + os.environ.get('CACHE_REDIS_DB', '1'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+    # локальный кэш узла, сбрасывается по тегам событиями изменений каталога
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': int(os.environ.get('LOCAL_CACHE_TIMEOUT', 60)),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+# время жизни кэша дерева категорий, сек. (сбрасывается при изменении категорий)
+CATEGORY_TREE_CACHE_TIMEOUT = 24 * 60 * 60
+
+# подсчет кол-ва в постраничных ответах: exact - всегда точный COUNT,
+# estimate - выше порога оценка планировщика, cached - выше порога точное значение из кэша
+PAGINATION_COUNT_MODE = os.environ.get('PAGINATION_COUNT_MODE', 'exact')
+PAGINATION_EXACT_COUNT_LIMIT = 1000
+PAGINATION_COUNT_CACHE_TIMEOUT = 5 * 60
+
+# границы ценовых диапазонов фасетов и время жизни кэша фасетов, сек.
+FACET_PRICE_BUCKETS = [0, 100, 500, 1000, 5000]
+FACET_CACHE_TIMEOUT = 60
+
+# автодополнение: минимальная длина ввода, число подсказок, лимит времени запроса (мс) и время жизни кэша, сек.
+AUTOCOMPLETE_MIN_LENGTH = 3
+AUTOCOMPLETE_LIMIT = 8
+AUTOCOMPLETE_STATEMENT_TIMEOUT = 200
+AUTOCOMPLETE_CACHE_TIMEOUT = 5 * 60
+
+# кэш результатов поиска: время жизни, сек., и максимальное кол-во id в закэшированном списке
+SEARCH_CACHE_TIMEOUT = 5 * 60
+SEARCH_CACHE_MAX_RESULTS = 1000
+# счетчики популярности: сколько запросов хранить и сколько самых частых прогревать
+SEARCH_STATS_MAX_QUERIES = 10000
+SEARCH_PREWARM_QUERIES = 100
+
+# время, в течение которого общие кэши (прокси, CDN) могут отдавать ответы каталога без проверки, сек.
+CATALOG_CACHE_MAX_AGE = int(os.environ.get('CATALOG_CACHE_MAX_AGE', 60))
+
+# события изменений каталога (outbox): канал redis, размер пачки публикации, срок хранения
+# опубликованных событий, сек., подписчик узла (включается на веб-узлах, запускается в процессе
+# при первом обращении к локальному кэшу) и пауза переподключения, сек.
+CHANGE_LOCAL_CACHE = 'local'
+CHANGE_CHANNEL = 'shop:changes'
+CHANGE_PUBLISH_BATCH_SIZE = 500
+CHANGE_EVENT_RETENTION = 24 * 60 * 60
+CHANGE_SUBSCRIBER_ENABLED = bool(int(os.environ.get('CHANGE_SUBSCRIBER_ENABLED', default=0)))
+CHANGE_SUBSCRIBER_RETRY = 1
+
+# хранилище открытых корзин: db - таблица Cart, redis - хеш в redis с отложенной записью в БД;
+# срок хранения корзины в redis, сек., и кол-во корзин, записываемых в БД за один запуск
+CART_STORAGE = os.environ.get('CART_STORAGE', 'db')
+CART_REDIS_TIMEOUT = 30 * 24 * 60 * 60
+CART_PERSIST_BATCH_SIZE = 500
+# отдельное подключение к redis для корзин: очистка и вытеснение ключей кэша не затрагивают корзины
+CART_REDIS = {
+    'host': REDIS_HOST,
+    'port': REDIS_PORT,
+    'db': os.environ.get('CART_REDIS_DB', REDIS_DB),
+}
+
+# время жизни закэшированных карточек товаров, сек.
+PRODUCT_CARD_CACHE_TIMEOUT = 24 * 60 * 60
+
 # подлючение системы оплаты
 CELERY_BROKER_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
@@ -149,6 +222,62 @@ CELERY_RESULT_BACKEND = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 CELERY_ACCEPT_BACKEND = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+CELERY_BEAT_SCHEDULE = {
+    'flush-purchases': {
+        'task': 'shop.tasks.flush_purchases',
+        'schedule': float(os.environ.get('RECOMMENDER_FLUSH_INTERVAL', 5)),
+    },
+    'trim-purchases': {
+        'task': 'shop.tasks.trim_purchases',
+        'schedule': 60 * 60,
+    },
+    'rescale-purchases': {
+        'task': 'shop.tasks.rescale_purchases',
+        'schedule': 24 * 60 * 60,
+    },
+    'persist-carts': {
+        'task': 'shop.tasks.persist_carts',
+        'schedule': 60,
+    },
+    'sweep-changes': {
+        'task': 'shop.tasks.sweep_changes',
+        'schedule': 30,
+    },
+    'prewarm-search': {
+        'task': 'shop.tasks.prewarm_search',
+        'schedule': 5 * 60,
+    },
+}
+
+# настройки системы рекомендаций
+# хранилище: shop.recommender.backends.RedisBackend, ShardedRedisBackend
+# (OPTIONS: {'nodes': [{'host': ..., 'port': ..., 'db': ...}, ...]}) или MemoryBackend
+RECOMMENDER_BACKEND = {
+    'BACKEND': 'shop.recommender.backends.RedisBackend',
+    'OPTIONS': {
+        'host': REDIS_HOST,
+        'port': REDIS_PORT,
+        'db': REDIS_DB,
+        'max_connections': int(os.environ.get('RECOMMENDER_MAX_CONNECTIONS', 50)),
+    },
+}
+# накапливать заказы в очереди и записывать рейтинги пачками (celery beat)
+RECOMMENDER_COALESCE_PURCHASES = bool(int(os.environ.get('RECOMMENDER_COALESCE_PURCHASES', default=0)))
+RECOMMENDER_FLUSH_BATCH_SIZE = 1000
+# время жизни кэша рекомендаций, сек.
+RECOMMENDER_CACHE_TIMEOUT = int(os.environ.get('RECOMMENDER_CACHE_TIMEOUT', 60))
+# максимальное кол-во рекомендаций, хранимых для одного товара (0 - без ограничения)
+RECOMMENDER_MAX_SUGGESTIONS = int(os.environ.get('RECOMMENDER_MAX_SUGGESTIONS', 100))
+# обрезать рекомендации при каждой записи, иначе только периодической задачей
+RECOMMENDER_TRIM_ON_WRITE = bool(int(os.environ.get('RECOMMENDER_TRIM_ON_WRITE', default=1)))
+# при записи рекомендации обрезаются с запасом (RECOMMENDER_MAX_SUGGESTIONS * RECOMMENDER_TRIM_SLACK),
+# до RECOMMENDER_MAX_SUGGESTIONS - периодической задачей: новый товар успевает набрать рейтинг
+RECOMMENDER_TRIM_SLACK = int(os.environ.get('RECOMMENDER_TRIM_SLACK', 2))
+# период полураспада рейтингов рекомендаций в днях (0 - без затухания)
+RECOMMENDER_DECAY_HALF_LIFE_DAYS = float(os.environ.get('RECOMMENDER_DECAY_HALF_LIFE_DAYS', 0))
+# кол-во хранимых персональных рекомендаций и время их жизни, сек.
+RECOMMENDER_USER_MAX_SUGGESTIONS = 50
+RECOMMENDER_USER_TIMEOUT = int(os.environ.get('RECOMMENDER_USER_TIMEOUT', 7 * 24 * 60 * 60))
 
 # подлючение системы оплаты
 Configuration.configure(
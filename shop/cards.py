@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Product
+from .service import bump_version, get_version
+
+# версия карточек товаров, меняется при переименовании брендов и категорий
+PRODUCT_CARD_VERSION_KEY = 'product_card:version'
+# поля краткой карточки в списках рекомендаций
+SHORT_CARD_FIELDS = ('id', 'name', 'price')
+
+
+def get_product_card_key(product_id, version):
+    return f'product_card:{version}:{product_id}'
+
+
+def render_product_cards(product_ids):
+    """ карточки товаров из БД: один запрос товаров с брендом и один запрос категорий """
+    from .serializers import ProductCardSerializer
+
+    products = Product.objects.filter(pk__in=product_ids).select_related('brand').prefetch_related('category')
+    return {card['id']: card for card in ProductCardSerializer(products, many=True).data}
+
+
+def get_product_cards(product_ids):
+    """ карточки товаров по id одним запросом к кэшу, недостающие собираются из БД и кэшируются """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return {}
+    version = get_version(PRODUCT_CARD_VERSION_KEY)
+    keys = {get_product_card_key(product_id, version): product_id for product_id in product_ids}
+    cards = {keys[key]: card for key, card in cache.get_many(keys).items()}
+    missing = product_ids - set(cards)
+    if missing:
+        rendered = render_product_cards(missing)
+        cache.set_many(
+            {get_product_card_key(product_id, version): card for product_id, card in rendered.items()},
+            settings.PRODUCT_CARD_CACHE_TIMEOUT
+        )
+        cards.update(rendered)
+    return cards
+
+
+def get_short_cards(product_ids, cards=None):
+    """ краткие карточки товаров в порядке списка id """
+    if cards is None:
+        cards = get_product_cards(product_ids)
+    return [{field: cards[id][field] for field in SHORT_CARD_FIELDS} for id in product_ids if id in cards]
+
+
+def delete_product_cards(product_ids):
+    """ удаление карточек измененных товаров """
+    version = get_version(PRODUCT_CARD_VERSION_KEY)
+    cache.delete_many([get_product_card_key(product_id, version) for product_id in product_ids])
+
+
+def bump_product_cards_version():
+    """ сброс всех карточек: изменились названия брендов или категорий """
+    bump_version(PRODUCT_CARD_VERSION_KEY)
@@ -0,0 +1,199 @@
+import logging
+from decimal import Decimal
+
+import redis
+
+from django.conf import settings
+from django.db import transaction
+
+from rest_framework import serializers
+
+from .cards import get_product_cards, get_short_cards
+from .models import Cart, Product
+
+logger = logging.getLogger(__name__)
+
+# id пользователей, корзины которых изменились после последней записи в БД
+CART_DIRTY_KEY = 'cart:dirty'
+
+_client = None
+
+# заполнение хеша строками Cart, если корзина еще не загружалась: отметка загрузки ставится в том же скрипте,
+# поэтому параллельная загрузка не вернет товары, удаленные после первой
+# KEYS: хеш корзины, отметка загрузки; ARGV: срок жизни, затем пары id товара, кол-во
+LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[1])
+return 1
+"""
+
+# уменьшение кол-ва товаров на оформленное в заказе, товары без остатка удаляются
+# KEYS: хеш корзины; ARGV: пары id товара, кол-во
+RELEASE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+
+def get_cart_redis():
+    """ соединение с redis корзин (CART_REDIS), отдельное от кэша """
+    global _client
+    if _client is None:
+        _client = redis.StrictRedis(**settings.CART_REDIS)
+    return _client
+
+
+def use_redis_cart():
+    """ открытые корзины хранятся в redis (CART_STORAGE = 'redis') """
+    return settings.CART_STORAGE == 'redis'
+
+
+class RedisCart:
+    """
+    Открытая корзина пользователя в хеше redis cart:<id пользователя> (id товара -> кол-во);
+    изменения атомарны (HINCRBY), запись в таблицу Cart - отложенно и при оформлении заказа.
+    Пустая корзина не хранится в redis, поэтому загрузка из БД отмечается отдельным ключом cart:<id>:loaded
+    """
+    sum_field = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+    def __init__(self, user_id, client=None):
+        self.user_id = user_id
+        self.client = client or get_cart_redis()
+        self.key = f'cart:{user_id}'
+        self.loaded_key = f'cart:{user_id}:loaded'
+
+    def load(self):
+        """
+        заполнение хеша открытыми строками Cart, если корзина еще не загружалась или истекла в redis,
+        иначе запись в БД удалила бы строки, которых нет в хеше
+        """
+        if self.client.exists(self.loaded_key):
+            return
+        rows = Cart.objects.filter(customer_id=self.user_id, order__isnull=True).values_list('product_id', 'quantity')
+        self.client.register_script(LOAD_SCRIPT)(
+            keys=[self.key, self.loaded_key],
+            args=[settings.CART_REDIS_TIMEOUT] + [value for row in rows for value in row]
+        )
+
+    def write(self, command, *args):
+        """ изменение хеша вместе с продлением срока жизни и отметкой для записи в БД, одной транзакцией redis """
+        self.load()
+        pipeline = self.client.pipeline()
+        getattr(pipeline, command)(self.key, *args)
+        pipeline.expire(self.key, settings.CART_REDIS_TIMEOUT)
+        pipeline.expire(self.loaded_key, settings.CART_REDIS_TIMEOUT)
+        pipeline.sadd(CART_DIRTY_KEY, self.user_id)
+        return pipeline.execute()[0]
+
+    def add(self, product_id, quantity=1):
+        """ добавление товара, возвращает новое кол-во """
+        return self.write('hincrby', product_id, quantity)
+
+    def set(self, product_id, quantity):
+        """ установка кол-ва товара, при нуле товар удаляется; False - товара нет в корзине """
+        self.load()
+        if not self.client.hexists(self.key, product_id):
+            return False
+        if quantity > 0:
+            self.write('hset', product_id, quantity)
+        elif quantity == 0:
+            self.write('hdel', product_id)
+        return True
+
+    def remove(self, product_id):
+        """ удаление товара; False - товара нет в корзине """
+        return bool(self.write('hdel', product_id))
+
+    def items(self):
+        """ содержимое корзины: id товара -> кол-во """
+        self.load()
+        return {int(product_id): int(quantity) for product_id, quantity in self.client.hgetall(self.key).items()}
+
+    def reset(self):
+        """ сброс корзины в redis: при следующем обращении она снова загружается из строк Cart """
+        self.client.delete(self.key, self.loaded_key)
+
+    def release(self, items):
+        """
+        удаление из корзины оформленного в заказе кол-ва товаров (id товара -> кол-во);
+        товары, добавленные после записи корзины в БД, остаются
+        """
+        if items:
+            self.client.register_script(RELEASE_SCRIPT)(
+                keys=[self.key], args=[value for item in items.items() for value in item]
+            )
+
+    def lines(self):
+        """ позиции корзины в формате CartReadSerializer по карточкам товаров, id позиции - id товара """
+        items = self.items()
+        cards = get_product_cards(items)
+        return [
+            {
+                'id': card['id'],
+                'product': card,
+                'quantity': items[card['id']],
+                'sum': self.sum_field.to_representation(Decimal(card['price']) * items[card['id']]),
+                'order': None,
+            }
+            for card in get_short_cards(sorted(items), cards)
+        ]
+
+    def total(self):
+        """ стоимость и кол-во товаров корзины, как get_products_total_sum """
+        items = self.items()
+        if not items:
+            return {'final_cost': None, 'count': None}
+        cards = get_product_cards(items)
+        return {
+            'final_cost': sum(Decimal(cards[id]['price']) * quantity for id, quantity in items.items() if id in cards),
+            'count': sum(items.values()),
+        }
+
+    def persist(self):
+        """ открытые строки Cart пользователя приводятся к содержимому хеша, возвращается записанное содержимое """
+        items = self.items()
+        existing = set(Product.objects.filter(pk__in=items).values_list('pk', flat=True))
+        items = {product_id: quantity for product_id, quantity in items.items() if product_id in existing}
+        with transaction.atomic():
+            rows = {
+                cart.product_id: cart for cart in
+                Cart.objects.select_for_update().filter(customer_id=self.user_id, order__isnull=True)
+            }
+            Cart.objects.filter(pk__in=[cart.pk for product_id, cart in rows.items() if product_id not in items]).delete()
+            changed = []
+            for product_id, cart in rows.items():
+                if product_id in items and cart.quantity != items[product_id]:
+                    cart.quantity = items[product_id]
+                    changed.append(cart)
+            Cart.objects.bulk_update(changed, ['quantity'])
+            Cart.objects.bulk_create([
+                Cart(customer_id=self.user_id, product_id=product_id, quantity=quantity)
+                for product_id, quantity in items.items() if product_id not in rows
+            ])
+        return items
+
+
+def persist_dirty_carts(batch_size):
+    """ отложенная запись измененных корзин из redis в БД """
+    client = get_cart_redis()
+    user_ids = client.spop(CART_DIRTY_KEY, batch_size)
+    failed = []
+    for user_id in user_ids:
+        try:
+            RedisCart(int(user_id), client).persist()
+        except Exception:
+            logger.exception('Ошибка записи корзины пользователя %s в БД', user_id)
+            failed.append(user_id)
+    if failed:
+        # id уже извлечены из множества, незаписанные корзины возвращаются для следующего запуска
+        client.sadd(CART_DIRTY_KEY, *failed)
+    return len(user_ids) - len(failed)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from redis import RedisError
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from .models import ChangeEvent
+
+logger = logging.getLogger(__name__)
+
+_subscriber = None
+_subscriber_pid = None
+_subscriber_lock = threading.Lock()
+
+
+def get_local_cache():
+    """ локальный кэш узла, сбрасывается по тегам из событий изменений """
+    return caches[settings.CHANGE_LOCAL_CACHE]
+
+
+def get_tag_versions(tags):
+    """ текущие версии тегов в локальном кэше, отсутствующие версии создаются """
+    local = get_local_cache()
+    keys = [f'tag:{tag}' for tag in sorted(set(tags))]
+    versions = local.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            local.add(key, uuid.uuid4().hex, None)
+            versions[key] = local.get(key)
+    return versions
+
+
+def get_local_cached(key, tags, compute, timeout=DEFAULT_TIMEOUT):
+    """ значение из локального кэша, актуальное пока не сброшен ни один из тегов; compute() - при промахе """
+    if settings.CHANGE_SUBSCRIBER_ENABLED:
+        start_change_subscriber()
+    digest = hashlib.md5(json.dumps([key, get_tag_versions(tags)], sort_keys=True).encode()).hexdigest()
+    cache_key = f'{key}:{digest}'
+    local = get_local_cache()
+    value = local.get(cache_key)
+    if value is None:
+        value = compute()
+        local.set(cache_key, value, timeout)
+    return value
+
+
+def invalidate_tags(tags):
+    """ сброс локального кэша по тегам: значения с прежними версиями тегов становятся недоступны """
+    get_local_cache().delete_many([f'tag:{tag}' for tag in tags])
+
+
+def record_change(tags):
+    """
+    запись события изменения в текущей транзакции; свой узел сбрасывает кэш после коммита,
+    остальные - после публикации события
+    """
+    tags = sorted(set(tags))
+    ChangeEvent.objects.create(tags=tags)
+    # до коммита сброс бесполезен: параллельный запрос снова закэширует незафиксированное состояние
+    transaction.on_commit(lambda: invalidate_tags(tags))
+    transaction.on_commit(schedule_publish)
+
+
+def schedule_publish():
+    from .tasks import publish_changes
+
+    publish_changes.delay()
+
+
+def publish_changes(batch_size):
+    """
+    публикация неопубликованных событий пачками, одно сообщение с тегами на пачку;
+    строки блокируются с SKIP LOCKED, поэтому параллельные публикации не пересекаются
+    """
+    client = get_redis_connection('default')
+    published = 0
+    while True:
+        with transaction.atomic():
+            events = list(
+                ChangeEvent.objects.select_for_update(skip_locked=True).filter(
+                    published_at__isnull=True
+                ).order_by('id')[:batch_size]
+            )
+            if not events:
+                return published
+            tags = sorted({tag for event in events for tag in event.tags})
+            client.publish(settings.CHANGE_CHANNEL, json.dumps(tags))
+            ChangeEvent.objects.filter(pk__in=[event.pk for event in events]).update(published_at=timezone.now())
+        published += len(events)
+
+
+def delete_published_changes():
+    """ удаление опубликованных событий старше срока хранения """
+    threshold = timezone.now() - timedelta(seconds=settings.CHANGE_EVENT_RETENTION)
+    return ChangeEvent.objects.filter(published_at__lt=threshold).delete()[0]
+
+
+class ChangeSubscriber(threading.Thread):
+    """ Подписка узла на канал событий изменений: сброс локального кэша по тегам без опроса """
+
+    def __init__(self):
+        super().__init__(name='change-subscriber', daemon=True)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(settings.CHANGE_CHANNEL)
+                # события, пропущенные без подписки, не восстановить: локальный кэш очищается целиком
+                get_local_cache().clear()
+                for message in pubsub.listen():
+                    # ошибка в одном сообщении не останавливает поток, сброс по тегам заменяется полной очисткой
+                    try:
+                        invalidate_tags(json.loads(message['data']))
+                    except Exception:
+                        logger.exception('Ошибка обработки события изменений: %r', message.get('data'))
+                        get_local_cache().clear()
+            except RedisError:
+                logger.warning('Подписка на события изменений прервана, переподключение', exc_info=True)
+                get_local_cache().clear()
+                time.sleep(settings.CHANGE_SUBSCRIBER_RETRY)
+
+
+def start_change_subscriber():
+    """
+    запуск подписчика событий изменений в текущем процессе (один раз) при первом обращении к локальному кэшу:
+    потоки не переживают fork, поэтому подписчик запускается в рабочем процессе, а не при загрузке приложения
+    """
+    global _subscriber, _subscriber_pid
+    if _subscriber_pid == os.getpid():
+        return
+    with _subscriber_lock:
+        if _subscriber_pid != os.getpid():
+            _subscriber = ChangeSubscriber()
+            _subscriber.start()
+            _subscriber_pid = os.getpid()
@@ -0,0 +1,25 @@
+import django_filters
+
+from .models import Product
+
+
+class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
+    """ Фильтр по списку чисел через запятую"""
+
+
+class ProductFilter(django_filters.FilterSet):
+    """ Фильтр товаров по диапазону цен, брендам (?brand=1,2) и категории"""
+    min_price = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
+    max_price = django_filters.NumberFilter(field_name='price', lookup_expr='lte')
+    brand = NumberInFilter(field_name='brand_id')
+    category = django_filters.NumberFilter(method='filter_category')
+
+    class Meta:
+        model = Product
+        fields = ['min_price', 'max_price', 'brand', 'category']
+
+    def filter_category(self, queryset, name, value):
+        # полусоединение по индексу связи товар-категория вместо join с дублированием строк
+        return queryset.filter(
+            pk__in=Product.category.through.objects.filter(category_id=value).values('product_id')
+        )
@@ -0,0 +1,21 @@
+from django.db.models import CharField, FloatField, Func, Lookup
+
+
+@CharField.register_lookup
+class TrigramWordSimilar(Lookup):
+    """ сходство строки с любым словом поля по триграммам (оператор pg_trgm %>), использует GIN индекс"""
+    lookup_name = 'trigram_word_similar'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} %%> {rhs}', lhs_params + rhs_params
+
+
+class TrigramWordSimilarity(Func):
+    """ степень сходства строки со словами поля, word_similarity(строка, поле)"""
+    function = 'WORD_SIMILARITY'
+    output_field = FloatField()
+
+    def __init__(self, expression, string, **extra):
+        super().__init__(string, expression, **extra)
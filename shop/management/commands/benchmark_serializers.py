@@ -0,0 +1,60 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_framework.renderers import JSONRenderer
+
+from shop.models import Product
+from shop.renderers import ORJSONRenderer
+from shop.serializers import CartReadFlatSerializer, CartReadSerializer, ProductForCategoryFlatSerializer, \
+    ProductForCategoryListSerializer
+from shop.service import get_product_sum
+
+
+class Command(BaseCommand):
+    """ Сравнение скорости ModelSerializer + JSONRenderer и плоских сериализаторов + ORJSONRenderer """
+    help = 'Замеряет вывод списков товаров и корзины обоими способами и проверяет совпадение ответов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--user', type=int, help='id пользователя, корзина которого выводится')
+
+    def measure(self, render, repeat):
+        content = render()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return content, (time.perf_counter() - started) / repeat * 1000
+
+    def compare(self, title, render_model, render_flat, repeat):
+        model_content, model_time = self.measure(render_model, repeat)
+        flat_content, flat_time = self.measure(render_flat, repeat)
+        if model_content != flat_content:
+            raise CommandError(f'{title}: ответы различаются')
+        self.stdout.write(
+            f'{title}: {model_time:.2f} мс -> {flat_time:.2f} мс, ускорение x{model_time / flat_time:.1f}'
+        )
+
+    def handle(self, *args, **options):
+        limit, repeat = options['limit'], options['repeat']
+        products = Product.objects.order_by('id')
+        self.compare(
+            f'Товары ({limit})',
+            lambda: JSONRenderer().render(ProductForCategoryListSerializer(products[:limit], many=True).data),
+            lambda: ORJSONRenderer().render(ProductForCategoryFlatSerializer(
+                products.values(*ProductForCategoryFlatSerializer.Meta.values)[:limit], many=True
+            ).data),
+            repeat
+        )
+        if options['user']:
+            carts = get_product_sum(get_user_model().objects.get(pk=options['user'])).order_by('id')
+            self.compare(
+                'Корзина',
+                lambda: JSONRenderer().render(CartReadSerializer(carts, many=True).data),
+                lambda: ORJSONRenderer().render(CartReadFlatSerializer(
+                    carts.values(*CartReadFlatSerializer.Meta.values), many=True
+                ).data),
+                repeat
+            )
@@ -0,0 +1,33 @@
+import gzip
+import json
+
+from django.core.management.base import BaseCommand
+
+from shop.recommender import Recommender
+
+# версия формата снимка рекомендаций
+SNAPSHOT_FORMAT = 'recommendations/1'
+
+
+class Command(BaseCommand):
+    """
+    Снимок рейтингов рекомендаций в файл gzip с JSON-строками:
+    первая строка - заголовок, далее по строке [id товара, [[id, рейтинг], ...]] на товар
+    """
+    help = 'Сохраняет рекомендации товаров в файл для быстрого прогрева нового сервера'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        recommender = Recommender()
+        header = {'format': SNAPSHOT_FORMAT, 'decay_epoch': recommender.get_decay_epoch()}
+        count = 0
+        with gzip.open(options['path'], 'wt', encoding='utf-8') as snapshot:
+            snapshot.write(json.dumps(header) + '\n')
+            for batch in recommender.export_purchases(options['batch_size']):
+                for product_id, scores in batch:
+                    snapshot.write(json.dumps([product_id, scores], separators=(',', ':')) + '\n')
+                count += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Сохранены рекомендации для {count} товаров'))
@@ -0,0 +1,41 @@
+import gzip
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.recommender import Recommender
+
+from .dump_recommendations import SNAPSHOT_FORMAT
+
+
+class Command(BaseCommand):
+    """ Загрузка снимка рейтингов рекомендаций пакетной записью """
+    help = 'Загружает рекомендации товаров из файла, созданного dump_recommendations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--clear', action='store_true', help='удалить рекомендации, которых нет в снимке')
+
+    def handle(self, *args, **options):
+        recommender = Recommender()
+        batch_size = options['batch_size']
+        product_ids = []
+        with gzip.open(options['path'], 'rt', encoding='utf-8') as snapshot:
+            header = json.loads(snapshot.readline() or '{}')
+            if header.get('format') != SNAPSHOT_FORMAT:
+                raise CommandError('Неизвестный формат снимка: {}'.format(header.get('format')))
+            recommender.backend.set(recommender.get_decay_epoch_key(), header['decay_epoch'])
+            batch = {}
+            for line in snapshot:
+                product_id, scores = json.loads(line)
+                batch[product_id] = scores
+                if len(batch) == batch_size:
+                    recommender.replace_purchases(batch)
+                    product_ids.extend(batch)
+                    batch = {}
+            recommender.replace_purchases(batch)
+            product_ids.extend(batch)
+        if options['clear']:
+            recommender.clear_purchases_except(product_ids)
+        self.stdout.write(self.style.SUCCESS(f'Загружены рекомендации для {len(product_ids)} товаров'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Category
+from shop.service import bump_category_tree_version
+
+
+class Command(BaseCommand):
+    """ Заполнение материализованных путей дерева категорий """
+    help = 'Пересчитывает пути и уровни вложенности всех категорий'
+
+    def handle(self, *args, **options):
+        positions = {}
+        parents = dict(Category.objects.values_list('pk', 'parent_id'))
+
+        def get_path(pk):
+            if pk not in positions:
+                parent_id = parents[pk]
+                positions[pk] = (get_path(parent_id) if parent_id else '') + f'{pk}/'
+            return positions[pk]
+
+        categories = list(Category.objects.only('pk', 'path', 'depth'))
+        for category in categories:
+            category.path = get_path(category.pk)
+            category.depth = category.path.count('/') - 1
+        Category.objects.bulk_update(categories, ['path', 'depth'], batch_size=500)
+        bump_category_tree_version()
+        self.stdout.write(self.style.SUCCESS(f'Обновлено категорий: {len(categories)}'))
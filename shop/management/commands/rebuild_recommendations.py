@@ -0,0 +1,134 @@
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from shop.models import Cart, Product
+from shop.recommender import Recommender
+
+
+class Command(BaseCommand):
+    """
+    Пересчет матрицы совместных покупок по истории заказов.
+    Позиции заказов читаются потоком пачками заказов, матрица копится в разреженном виде
+    и периодически сохраняется в файл, поэтому прерванный пересчет продолжается с места остановки.
+    """
+    help = 'Пересчитывает рекомендации товаров по истории заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='кол-во заказов в пачке')
+        parser.add_argument('--top', type=int, default=settings.RECOMMENDER_MAX_SUGGESTIONS or 100)
+        parser.add_argument('--checkpoint', default=os.path.join(tempfile.gettempdir(), 'recommendations.npz'))
+        parser.add_argument('--checkpoint-every', type=int, default=10, help='сохранять матрицу каждые N пачек')
+        parser.add_argument('--restart', action='store_true', help='не продолжать с сохраненной точки')
+
+    def handle(self, *args, **options):
+        size = (Product.objects.aggregate(max_id=Max('pk'))['max_id'] or 0) + 1
+        matrix, last_order_id = self.load_checkpoint(options['checkpoint'], size, options['restart'])
+        if last_order_id:
+            self.stdout.write(f'Продолжение с заказа {last_order_id}')
+
+        recommender = Recommender()
+        half_life = recommender.get_decay_half_life()
+        epoch = recommender.get_decay_epoch() if half_life else 0
+        chunks = 0
+        for order_ids, product_ids, dates in self.iter_chunks(last_order_id, options['chunk_size']):
+            # при включенном затухании заказ весит 2^((дата - точка отсчета) / полураспад)
+            weights = np.exp2((dates - epoch) / half_life) if half_life else None
+            matrix = matrix + self.count_pairs(order_ids, product_ids, size, weights)
+            last_order_id = int(order_ids[-1])
+            chunks += 1
+            if chunks % options['checkpoint_every'] == 0:
+                self.save_checkpoint(options['checkpoint'], matrix, last_order_id)
+        self.save_checkpoint(options['checkpoint'], matrix, last_order_id)
+
+        loaded = self.load_top(matrix.tocsr(), options['top'], recommender=recommender)
+        os.remove(options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS(f'Загружены рекомендации для {loaded} товаров'))
+
+    def iter_chunks(self, last_order_id, chunk_size):
+        """ позиции заказов пачками целых заказов в виде массивов (id заказа, id товара, дата заказа) """
+        rows = Cart.objects.filter(order__isnull=False, order_id__gt=last_order_id).order_by(
+            'order_id'
+        ).values_list('order_id', 'product_id', 'order__date_add').iterator(chunk_size=2000)
+        order_ids, product_ids, dates = [], [], []
+        orders = 0
+        for order_id, product_id, date_add in rows:
+            if not order_ids or order_ids[-1] != order_id:
+                if orders == chunk_size:
+                    yield np.array(order_ids), np.array(product_ids), np.array(dates)
+                    order_ids, product_ids, dates = [], [], []
+                    orders = 0
+                orders += 1
+            order_ids.append(order_id)
+            product_ids.append(product_id)
+            dates.append(date_add.timestamp())
+        if order_ids:
+            yield np.array(order_ids), np.array(product_ids), np.array(dates)
+
+    def count_pairs(self, order_ids, product_ids, size, weights=None):
+        """ матрица совместных покупок пачки заказов: X.T * W * X без диагонали """
+        # товары, созданные во время пересчета, не попадают в матрицу
+        known = product_ids < size
+        order_ids, product_ids = order_ids[known], product_ids[known]
+        if not len(product_ids):
+            return sparse.csr_matrix((size, size))
+        _, rows = np.unique(order_ids, return_inverse=True)
+        incidence = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float64), (rows, product_ids)), shape=(rows.max() + 1, size)
+        )
+        # один товар в заказе учитывается один раз
+        incidence.data[:] = 1
+        weighted = incidence
+        if weights is not None:
+            order_weights = np.zeros(incidence.shape[0])
+            order_weights[rows] = weights[known]
+            weighted = sparse.diags(order_weights) @ incidence
+        pairs = (incidence.T @ weighted).tocsr()
+        pairs.setdiag(0)
+        pairs.eliminate_zeros()
+        return pairs
+
+    def load_checkpoint(self, path, size, restart):
+        """ матрица и id последнего учтенного заказа из сохраненной точки """
+        if restart or not os.path.exists(path):
+            return sparse.csr_matrix((size, size)), 0
+        with np.load(path) as data:
+            matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            last_order_id = int(data['last_order_id'])
+        # товары, добавленные после сохранения, расширяют матрицу
+        if matrix.shape[0] < size:
+            matrix.resize((size, size))
+        return matrix, last_order_id
+
+    def save_checkpoint(self, path, matrix, last_order_id):
+        """ атомарное сохранение матрицы и id последнего учтенного заказа """
+        matrix = matrix.tocsr()
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+            shape=np.array(matrix.shape), last_order_id=np.array(last_order_id)
+        )
+        os.replace(tmp_path, path)
+
+    def load_top(self, matrix, top, batch_size=500, recommender=None):
+        """ загрузка лучших top рекомендаций каждого товара в хранилище пачками """
+        recommender = recommender or Recommender()
+        product_ids = np.flatnonzero(np.diff(matrix.indptr))
+        for start in range(0, len(product_ids), batch_size):
+            suggestions = {}
+            for product_id in product_ids[start:start + batch_size]:
+                row = slice(matrix.indptr[product_id], matrix.indptr[product_id + 1])
+                scores, with_ids = matrix.data[row], matrix.indices[row]
+                best = np.argsort(-scores, kind='stable')[:top]
+                suggestions[int(product_id)] = [
+                    (int(with_id), float(score)) for with_id, score in zip(with_ids[best], scores[best])
+                ]
+            recommender.replace_purchases(suggestions)
+        recommender.clear_purchases_except(product_ids.tolist())
+        return len(product_ids)
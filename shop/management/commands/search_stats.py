@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from shop.service import get_popular_searches, prewarm_search_cache
+
+
+class Command(BaseCommand):
+    """ Самые частые поисковые запросы по счетчикам обращений """
+    help = 'Выводит самые частые поисковые запросы, с --prewarm заполняет для них кэш результатов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--prewarm', action='store_true')
+
+    def handle(self, *args, **options):
+        for query, hits in get_popular_searches(options['limit']):
+            self.stdout.write(f'{hits:>10}  {query}')
+        if options['prewarm']:
+            queries = prewarm_search_cache(options['limit'])
+            self.stdout.write(self.style.SUCCESS(f'Прогрето запросов: {len(queries)}'))
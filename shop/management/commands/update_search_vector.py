@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Product
+from shop.service import update_search_vector
+
+
+class Command(BaseCommand):
+    """ Заполнение сохраненного поискового вектора для всех товаров """
+    help = 'Пересчитывает поисковый вектор всех товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(product_ids), batch_size):
+            update_search_vector(product_ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'Обновлено товаров: {len(product_ids)}'))
@@ -1,6 +1,12 @@
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat, Substr
 from django.urls import reverse
+from django.utils import timezone
 from django.conf import settings
 
 from coupons.models import Coupon
@@ -36,6 +42,11 @@ class Category(models.Model):
     name = models.CharField('Название', max_length=255)
     sort_order = models.IntegerField('Порядок сортировки', default=0)
     url = models.SlugField('Url', max_length=255, unique=True)
+    # материализованный путь: id предков и самой категории через "/", например "1/5/12/"
+    path = models.CharField('Путь в дереве', max_length=255, db_index=True, editable=False, default='')
+    depth = models.PositiveSmallIntegerField('Уровень вложенности', default=0, editable=False)
+    # отметка изменения категории или товаров в ней и в ее потомках, валидатор условных запросов
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
 
     def __str__(self):
         return f'{self.name}, родитель: {self.parent}'
@@ -43,6 +54,39 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse("category_detail", kwargs={"slug": self.url})
 
+    def get_tree_position(self):
+        """ путь и уровень вложенности категории по пути родителя из БД """
+        parent_path = ''
+        if self.parent_id:
+            parent_path = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True).get()
+        path = f'{parent_path}{self.pk}/'
+        return path, path.count('/') - 1
+
+    def save(self, *args, **kwargs):
+        """
+        сохранение с пересчетом материализованного пути; при переносе категории
+        пути потомков обновляются одним запросом, при удалении потомки удаляются каскадно
+        """
+        if self.pk is None:
+            super().save(*args, **kwargs)
+            self.path, self.depth = self.get_tree_position()
+            Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+            return
+        old_path, old_depth = Category.objects.filter(pk=self.pk).values_list('path', 'depth').first() or ('', 0)
+        path, depth = self.get_tree_position()
+        if old_path and path != old_path and path.startswith(old_path):
+            raise ValueError('Категорию нельзя перенести в ее же потомка')
+        self.path, self.depth = path, depth
+        super().save(*args, **kwargs)
+        if old_path and path != old_path:
+            Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(Value(path), Substr('path', len(old_path) + 1)),
+                depth=F('depth') + (depth - old_depth),
+            )
+            # товары поддерева ушли от прежних предков и появились у новых
+            ancestor_ids = {int(pk) for pk in (old_path + path).split('/') if pk}
+            Category.objects.filter(pk__in=ancestor_ids).update(updated_at=timezone.now())
+
     class Meta:
         verbose_name = "Категория"
         verbose_name_plural = "Категории"
@@ -61,6 +105,15 @@ class Brand(models.Model):
     class Meta:
         verbose_name = "Бренд"
         verbose_name_plural = "Бренды"
+        indexes = [
+            GinIndex(name='shop_brand_name_trgm', fields=['name'], opclasses=['gin_trgm_ops']),
+        ]
+
+
+class ProductManager(models.Manager):
+    """ Менеджер товаров: поисковый вектор не загружается вместе с товаром """
+    def get_queryset(self):
+        return super().get_queryset().defer('search_vector')
 
 
 class Product(models.Model):
@@ -72,6 +125,10 @@ class Product(models.Model):
     description = models.TextField('Описание', null=True, blank=True)
     price = models.DecimalField('Цена', max_digits=12, decimal_places=2)
     category = models.ManyToManyField(Category, verbose_name='Категории', related_name='products')
+    search_vector = SearchVectorField('Поисковый вектор', null=True, editable=False)
+    # меняется и при переименовании бренда или категорий товара, валидатор условных запросов
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    objects = ProductManager()
 
     def __str__(self):
         return f'{self.name} {self.brand} , {self.category}'
@@ -79,6 +136,16 @@ class Product(models.Model):
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
+        indexes = [
+            GinIndex(fields=['search_vector']),
+            # автодополнение по названию с учетом опечаток
+            GinIndex(name='shop_product_name_trgm', fields=['name'], opclasses=['gin_trgm_ops']),
+            # ключи пагинации по курсору: (поле сортировки, id)
+            models.Index(fields=['name', 'id']),
+            models.Index(fields=['price', 'id']),
+            # фильтр по бренду с диапазоном цен
+            models.Index(fields=['brand', 'price']),
+        ]
 
 
 class Cart(models.Model):
@@ -124,3 +191,24 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
 
+
+class ChangeEvent(models.Model):
+    """
+        Событие изменения каталога (outbox): пишется в транзакции изменения,
+        затем публикуется в redis для сброса локальных кэшей всех узлов по тегам
+    """
+    tags = ArrayField(models.CharField(max_length=64), verbose_name='Теги')
+    created_at = models.DateTimeField('Дата создания', auto_now_add=True)
+    published_at = models.DateTimeField('Дата публикации', null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.pk}: {", ".join(self.tags)}'
+
+    class Meta:
+        verbose_name = 'Событие изменения'
+        verbose_name_plural = 'События изменений'
+        indexes = [
+            # выборка неопубликованных событий по порядку
+            models.Index(fields=['id'], name='shop_changeevent_unpublished', condition=Q(published_at__isnull=True)),
+            models.Index(fields=['published_at']),
+        ]
@@ -0,0 +1,240 @@
+import json
+import time
+
+from collections import Counter, defaultdict
+from itertools import permutations
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..models import Cart
+from .backends import get_backend
+
+
+class Recommender(object):
+    """
+    Класс для реализации системы рекомендаций для товаров
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend()
+
+    def get_product_key(self, id):
+        """ возвращает ключ продукта для записи в хранилище """
+        return 'product:{}:purchased_with'.format(id)
+
+    def get_product_id(self, key):
+        """ возвращает id продукта по ключу хранилища """
+        return int(key.split(':')[1])
+
+    def get_user_key(self, user_id):
+        """ возвращает ключ персональных рекомендаций пользователя """
+        return 'user:{}:recommended'.format(user_id)
+
+    def get_user_purchased_key(self, user_id):
+        """ возвращает ключ множества товаров, купленных пользователем """
+        return 'user:{}:purchased'.format(user_id)
+
+    def get_pending_key(self):
+        """ возвращает ключ очереди покупок, ожидающих записи в хранилище """
+        return 'recommender:pending_purchases'
+
+    def get_decay_epoch_key(self):
+        """ возвращает ключ точки отсчета затухания рейтингов """
+        return 'recommender:decay_epoch'
+
+    def get_decay_epoch(self):
+        """ точка отсчета затухания (unix time), к которой приведены текущие рейтинги """
+        epoch = self.backend.get(self.get_decay_epoch_key())
+        if epoch is None:
+            epoch = self.backend.setnx(self.get_decay_epoch_key(), time.time())
+        return float(epoch)
+
+    def get_decay_half_life(self):
+        """ период полураспада рейтингов в секундах, 0 - затухание выключено """
+        return settings.RECOMMENDER_DECAY_HALF_LIFE_DAYS * 24 * 60 * 60
+
+    def get_weight(self, timestamp=None):
+        """
+        вес покупки в момент timestamp: вместо уменьшения всех рейтингов со временем
+        новые покупки весят экспоненциально больше относительно точки отсчета
+        """
+        half_life = self.get_decay_half_life()
+        if not half_life:
+            return 1
+        timestamp = time.time() if timestamp is None else timestamp
+        return 2 ** ((timestamp - self.get_decay_epoch()) / half_life)
+
+    def count_pairs(self, orders):
+        """ подсчет пар товаров, купленных вместе, по спискам id товаров заказов """
+        pairs = Counter()
+        for product_ids in orders:
+            pairs.update(permutations(set(product_ids), 2))
+        return pairs
+
+    def add_pairs(self, pairs, weight=1):
+        """ запись приращений рейтингов одним пакетом """
+        if not pairs:
+            return
+        increments = defaultdict(dict)
+        for (product_id, with_id), amount in pairs.items():
+            increments[self.get_product_key(product_id)][with_id] = amount * weight
+        max_size = None
+        if settings.RECOMMENDER_TRIM_ON_WRITE:
+            # обрезка ровно до RECOMMENDER_MAX_SUGGESTIONS удаляла бы новый товар сразу после записи
+            max_size = settings.RECOMMENDER_MAX_SUGGESTIONS * settings.RECOMMENDER_TRIM_SLACK
+        self.backend.increment(increments, max_size)
+
+    def products_bought(self, product_ids):
+        """ добавление купленных вместе товаров """
+        self.add_pairs(self.count_pairs([product_ids]), self.get_weight())
+
+    def queue_purchases(self, product_ids):
+        """ постановка заказа в очередь для пакетной записи """
+        self.backend.push(self.get_pending_key(), json.dumps(list(product_ids)))
+
+    def flush_purchases(self, batch_size=1000):
+        """ запись накопленных заказов одним пакетом, возвращает кол-во заказов """
+        orders = self.backend.pop(self.get_pending_key(), batch_size)
+        if orders:
+            self.add_pairs(self.count_pairs(json.loads(order) for order in orders), self.get_weight())
+        return len(orders)
+
+    def get_cache_key(self, product_id, max_results):
+        """ возвращает ключ кэша рекомендаций товара """
+        return 'recommended:{}:{}'.format(product_id, max_results)
+
+    def get_user_empty_key(self, user_id):
+        """ возвращает ключ кэша отметки об отсутствии персональных рекомендаций """
+        return 'recommended:user:{}:empty'.format(user_id)
+
+    def suggest_ids_for_many(self, product_ids, max_results=6):
+        """
+        id рекомендуемых товаров (по убыванию рейтинга) для каждого из товаров:
+        промахи кэша запрашиваются из хранилища одним пакетом
+        """
+        product_ids = list(dict.fromkeys(product_ids))
+        cache_keys = {product_id: self.get_cache_key(product_id, max_results) for product_id in product_ids}
+        cached = cache.get_many(cache_keys.values())
+        suggestions = {
+            product_id: cached[cache_key] for product_id, cache_key in cache_keys.items() if cache_key in cached
+        }
+        missing = [product_id for product_id in product_ids if product_id not in suggestions]
+        if missing:
+            top = self.backend.top([self.get_product_key(product_id) for product_id in missing], max_results)
+            fetched = {
+                product_id: [int(id) for id in ids] for product_id, ids in zip(missing, top)
+            }
+            cache.set_many(
+                {cache_keys[product_id]: ids for product_id, ids in fetched.items()},
+                settings.RECOMMENDER_CACHE_TIMEOUT
+            )
+            suggestions.update(fetched)
+        return suggestions
+
+    def suggest_ids_for(self, product_ids, max_results=6):
+        """ id товаров, рекомендуемых для набора товаров, по сумме их рейтингов """
+        product_ids = sorted(set(product_ids))
+        if len(product_ids) == 0:
+            return []
+        elif len(product_ids) == 1:
+            # Передан только один товар.
+            return self.suggest_ids_for_many(product_ids, max_results)[product_ids[0]]
+        cache_key = self.get_cache_key('-'.join(str(id) for id in product_ids), max_results)
+        suggestions = cache.get(cache_key)
+        if suggestions is None:
+            # Передано несколько товаров, суммируем рейтинги их рекомендаций на стороне хранилища.
+            keys = [self.get_product_key(id) for id in product_ids]
+            suggestions = [int(id) for id in self.backend.union_top(keys, product_ids, max_results)]
+            cache.set(cache_key, suggestions, settings.RECOMMENDER_CACHE_TIMEOUT)
+        return suggestions
+
+    def user_products_bought(self, user_id, product_ids):
+        """ добавление рейтингов купленных товаров в персональные рекомендации пользователя """
+        product_ids = sorted(set(product_ids))
+        if not product_ids:
+            return
+        timeout = settings.RECOMMENDER_USER_TIMEOUT
+        added, purchased = self.backend.add_members(self.get_user_purchased_key(user_id), product_ids, timeout)
+        cache.delete(self.get_user_empty_key(user_id))
+        if not added:
+            # рейтинги повторно купленных товаров уже учтены
+            return
+        user_key = self.get_user_key(user_id)
+        self.backend.union_store(
+            user_key, [user_key] + [self.get_product_key(id) for id in sorted(added, key=int)], purchased,
+            settings.RECOMMENDER_USER_MAX_SUGGESTIONS, timeout
+        )
+
+    def rebuild_user_suggestions(self, user_id):
+        """ расчет персональных рекомендаций по всем заказам пользователя """
+        product_ids = Cart.objects.filter(customer_id=user_id, order__isnull=False).values_list(
+            'product_id', flat=True
+        ).distinct()
+        self.backend.delete([self.get_user_key(user_id), self.get_user_purchased_key(user_id)])
+        self.user_products_bought(user_id, product_ids)
+
+    def suggest_ids_for_user(self, user_id, max_results=6):
+        """ id персональных рекомендаций: одно чтение готового рейтинга, расчет только при его отсутствии """
+        suggestions, = self.backend.top([self.get_user_key(user_id)], max_results)
+        if not suggestions and not cache.get(self.get_user_empty_key(user_id)):
+            self.rebuild_user_suggestions(user_id)
+            suggestions, = self.backend.top([self.get_user_key(user_id)], max_results)
+            if not suggestions:
+                # без истории покупок рекомендаций нет: отметка избавляет от повторного расчета на каждый запрос
+                cache.set(self.get_user_empty_key(user_id), True, settings.RECOMMENDER_CACHE_TIMEOUT)
+        return [int(id) for id in suggestions]
+
+    def scan_product_keys(self, batch_size=500):
+        """ обход ключей рекомендаций пачками """
+        return self.backend.scan(self.get_product_key('*'), batch_size)
+
+    def trim_purchases(self, max_size=None, batch_size=500):
+        """ обрезка рекомендаций каждого товара до max_size лучших """
+        max_size = max_size or settings.RECOMMENDER_MAX_SUGGESTIONS
+        if not max_size:
+            return
+        for keys in self.scan_product_keys(batch_size):
+            self.backend.trim(keys, max_size)
+
+    def rescale_purchases(self, min_score=0.01, batch_size=500):
+        """
+        перенос точки отсчета затухания на текущий момент: все рейтинги умножаются
+        на накопленный коэффициент затухания, слишком малые удаляются.
+        Приращения, записанные во время пересчета, могут быть учтены с небольшой погрешностью.
+        """
+        half_life = self.get_decay_half_life()
+        if not half_life:
+            return
+        now = time.time()
+        factor = 2 ** ((self.get_decay_epoch() - now) / half_life)
+        self.backend.set(self.get_decay_epoch_key(), now)
+        for keys in self.scan_product_keys(batch_size):
+            self.backend.scale(keys, factor, min_score)
+
+    def replace_purchases(self, suggestions):
+        """ замена рекомендаций товаров готовыми рейтингами {id: [(id, рейтинг), ...]} одним пакетом """
+        self.backend.replace({
+            self.get_product_key(product_id): scores for product_id, scores in suggestions.items()
+        })
+
+    def export_purchases(self, batch_size=500):
+        """ рейтинги всех товаров пачками [(id, [(id, рейтинг), ...]), ...] для снимка хранилища """
+        for keys in self.scan_product_keys(batch_size):
+            yield [
+                (self.get_product_id(key), [(int(with_id), score) for with_id, score in items])
+                for key, items in self.backend.items(keys).items() if items
+            ]
+
+    def clear_purchases_except(self, product_ids, batch_size=500):
+        """ удаление рекомендаций всех товаров, кроме переданных """
+        keep = {self.get_product_key(id) for id in product_ids}
+        for keys in self.scan_product_keys(batch_size):
+            self.backend.delete([key for key in keys if key not in keep])
+
+    def clear_purchases(self, batch_size=500):
+        """
+        удаление рекомендаций для продуктов
+        """
+        for keys in self.scan_product_keys(batch_size):
+            self.backend.delete(keys)
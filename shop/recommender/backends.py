@@ -0,0 +1,459 @@
+import fnmatch
+import threading
+import uuid
+import zlib
+
+from collections import Counter, defaultdict
+from heapq import nlargest
+
+import redis
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# сумма рейтингов нескольких ключей за один вызов на стороне redis:
+# KEYS[1] - уникальный временный ключ, KEYS[2..] - исходные ключи,
+# ARGV[1] - кол-во результатов, ARGV[2..] - исключаемые элементы
+UNION_TOP_SCRIPT = """
+redis.call('ZUNIONSTORE', KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+for i = 2, #ARGV, 1000 do
+    redis.call('ZREM', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+local result = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+redis.call('DEL', KEYS[1])
+return result
+"""
+
+# сохранение суммы рейтингов в ключ:
+# KEYS[1] - ключ результата, KEYS[2..] - исходные ключи (могут включать KEYS[1]),
+# ARGV[1] - кол-во хранимых элементов, ARGV[2] - время жизни в секундах, ARGV[3..] - исключаемые элементы
+UNION_STORE_SCRIPT = """
+redis.call('ZUNIONSTORE', KEYS[1], #KEYS - 1, unpack(KEYS, 2))
+for i = 3, #ARGV, 1000 do
+    redis.call('ZREM', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+"""
+
+
+class BaseBackend(object):
+    """
+    Интерфейс хранилища рекомендаций: значения, очереди, множества и рейтинги (sorted set).
+    Элементы возвращаются строками, рейтинги - по убыванию.
+    """
+
+    def get(self, key):
+        """ значение ключа или None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ запись значения """
+        raise NotImplementedError
+
+    def setnx(self, key, value):
+        """ запись значения, если ключа нет; возвращает итоговое значение """
+        raise NotImplementedError
+
+    def push(self, key, value):
+        """ добавление значения в конец очереди """
+        raise NotImplementedError
+
+    def pop(self, key, count):
+        """ атомарное извлечение до count значений из начала очереди """
+        raise NotImplementedError
+
+    def add_members(self, key, members, timeout=None):
+        """ добавление элементов в множество; возвращает (новые элементы, все элементы множества) """
+        raise NotImplementedError
+
+    def increment(self, increments, max_size=None):
+        """ приращение рейтингов {ключ: {элемент: приращение}} с обрезкой до max_size лучших """
+        raise NotImplementedError
+
+    def top(self, keys, count):
+        """ лучшие count элементов каждого из ключей """
+        raise NotImplementedError
+
+    def items(self, keys):
+        """ все элементы с рейтингами для каждого из ключей: {ключ: [(элемент, рейтинг), ...]} """
+        raise NotImplementedError
+
+    def union_top(self, keys, exclude, count):
+        """ лучшие count элементов суммы рейтингов ключей без исключаемых элементов """
+        raise NotImplementedError
+
+    def union_store(self, dest, keys, exclude, max_size, timeout=None):
+        """ сохранение суммы рейтингов ключей в dest без исключаемых элементов """
+        raise NotImplementedError
+
+    def replace(self, items, timeout=None):
+        """ замена рейтингов ключей готовыми значениями {ключ: [(элемент, рейтинг), ...]} """
+        raise NotImplementedError
+
+    def trim(self, keys, max_size):
+        """ обрезка рейтингов ключей до max_size лучших """
+        raise NotImplementedError
+
+    def scale(self, keys, factor, min_score):
+        """ умножение рейтингов ключей на factor с удалением рейтингов меньше min_score """
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """ удаление ключей """
+        raise NotImplementedError
+
+    def scan(self, pattern, batch_size=500):
+        """ обход ключей по шаблону пачками """
+        raise NotImplementedError
+
+
+class RedisBackend(BaseBackend):
+    """ Один сервер redis с пулом соединений """
+
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=None, **options):
+        self.pool = redis.ConnectionPool(
+            host=host, port=port, db=db, max_connections=max_connections, decode_responses=True, **options
+        )
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+        self.union_top_script = self.client.register_script(UNION_TOP_SCRIPT)
+        self.union_store_script = self.client.register_script(UNION_STORE_SCRIPT)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value):
+        self.client.set(key, value)
+
+    def setnx(self, key, value):
+        pipe = self.client.pipeline()
+        pipe.setnx(key, value)
+        pipe.get(key)
+        return pipe.execute()[1]
+
+    def push(self, key, value):
+        self.client.rpush(key, value)
+
+    def pop(self, key, count):
+        pipe = self.client.pipeline()
+        pipe.lrange(key, 0, count - 1)
+        pipe.ltrim(key, count, -1)
+        return pipe.execute()[0]
+
+    def add_members(self, key, members, timeout=None):
+        # прежние элементы читаются в той же транзакции MULTI, что и добавление
+        pipe = self.client.pipeline()
+        pipe.smembers(key)
+        if members:
+            pipe.sadd(key, *members)
+        if timeout:
+            pipe.expire(key, timeout)
+        existing = pipe.execute()[0]
+        members = {str(member) for member in members}
+        return members - existing, existing | members
+
+    def increment(self, increments, max_size=None):
+        pipe = self.client.pipeline(transaction=False)
+        for key, amounts in increments.items():
+            for member, amount in amounts.items():
+                pipe.zincrby(key, amount, member)
+            if max_size:
+                pipe.zremrangebyrank(key, 0, -max_size - 1)
+        pipe.execute()
+
+    def top(self, keys, count):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrange(key, 0, count - 1)
+        return pipe.execute()
+
+    def items(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrange(key, 0, -1, withscores=True)
+        return dict(zip(keys, pipe.execute()))
+
+    def union_top(self, keys, exclude, count):
+        tmp_key = 'tmp:union:{}'.format(uuid.uuid4().hex)
+        return self.union_top_script(keys=[tmp_key] + list(keys), args=[count] + list(exclude))
+
+    def union_store(self, dest, keys, exclude, max_size, timeout=None):
+        self.union_store_script(keys=[dest] + list(keys), args=[max_size, timeout or 0] + list(exclude))
+
+    def replace(self, items, timeout=None):
+        pipe = self.client.pipeline()
+        for key, scores in items.items():
+            pipe.delete(key)
+            if scores:
+                pipe.zadd(key, dict(scores))
+                if timeout:
+                    pipe.expire(key, timeout)
+        pipe.execute()
+
+    def trim(self, keys, max_size):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zremrangebyrank(key, 0, -max_size - 1)
+        pipe.execute()
+
+    def scale(self, keys, factor, min_score):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zunionstore(key, {key: factor})
+            pipe.zremrangebyscore(key, '-inf', '({}'.format(min_score))
+        pipe.execute()
+
+    def delete(self, keys):
+        if keys:
+            self.client.unlink(*keys)
+
+    def scan(self, pattern, batch_size=500):
+        keys = []
+        for key in self.client.scan_iter(match=pattern, count=batch_size):
+            keys.append(key)
+            if len(keys) == batch_size:
+                yield keys
+                keys = []
+        if keys:
+            yield keys
+
+
+class ShardedRedisBackend(BaseBackend):
+    """
+    Несколько серверов redis: ключ хранится на узле crc32(ключ) % кол-во узлов.
+    Суммы рейтингов ключей с разных узлов считаются на стороне приложения.
+    """
+
+    def __init__(self, nodes, **options):
+        self.nodes = [RedisBackend(**dict(options, **node)) for node in nodes]
+
+    def get_node(self, key):
+        """ узел, на котором хранится ключ """
+        return self.nodes[zlib.crc32(key.encode()) % len(self.nodes)]
+
+    def group(self, keys):
+        """ ключи, сгруппированные по узлам """
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.get_node(key)].append(key)
+        return groups.items()
+
+    def get(self, key):
+        return self.get_node(key).get(key)
+
+    def set(self, key, value):
+        self.get_node(key).set(key, value)
+
+    def setnx(self, key, value):
+        return self.get_node(key).setnx(key, value)
+
+    def push(self, key, value):
+        self.get_node(key).push(key, value)
+
+    def pop(self, key, count):
+        return self.get_node(key).pop(key, count)
+
+    def add_members(self, key, members, timeout=None):
+        return self.get_node(key).add_members(key, members, timeout)
+
+    def increment(self, increments, max_size=None):
+        for node, keys in self.group(increments):
+            node.increment({key: increments[key] for key in keys}, max_size)
+
+    def top(self, keys, count):
+        result = {}
+        for node, node_keys in self.group(keys):
+            result.update(zip(node_keys, node.top(node_keys, count)))
+        return [result[key] for key in keys]
+
+    def items(self, keys):
+        result = {}
+        for node, node_keys in self.group(keys):
+            result.update(node.items(node_keys))
+        return result
+
+    def merge(self, keys, exclude):
+        """ сумма рейтингов ключей без исключаемых элементов """
+        scores = Counter()
+        for items in self.items(keys).values():
+            for member, score in items:
+                scores[member] += score
+        for member in exclude:
+            scores.pop(str(member), None)
+        return scores
+
+    def union_top(self, keys, exclude, count):
+        scores = self.merge(keys, exclude)
+        return [member for member, _ in nlargest(count, scores.items(), key=score_order)]
+
+    def union_store(self, dest, keys, exclude, max_size, timeout=None):
+        scores = self.merge(keys, exclude)
+        self.get_node(dest).replace({dest: nlargest(max_size, scores.items(), key=score_order)}, timeout)
+
+    def replace(self, items, timeout=None):
+        for node, keys in self.group(items):
+            node.replace({key: items[key] for key in keys}, timeout)
+
+    def trim(self, keys, max_size):
+        for node, node_keys in self.group(keys):
+            node.trim(node_keys, max_size)
+
+    def scale(self, keys, factor, min_score):
+        for node, node_keys in self.group(keys):
+            node.scale(node_keys, factor, min_score)
+
+    def delete(self, keys):
+        for node, node_keys in self.group(keys):
+            node.delete(node_keys)
+
+    def scan(self, pattern, batch_size=500):
+        for node in self.nodes:
+            yield from node.scan(pattern, batch_size)
+
+
+class MemoryBackend(BaseBackend):
+    """ Хранилище в памяти процесса для тестов и замеров, время жизни ключей не учитывается """
+
+    def __init__(self, **options):
+        self.lock = threading.RLock()
+        self.values = {}
+        self.lists = defaultdict(list)
+        self.sets = defaultdict(set)
+        self.zsets = defaultdict(dict)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = str(value)
+
+    def setnx(self, key, value):
+        with self.lock:
+            return self.values.setdefault(key, str(value))
+
+    def push(self, key, value):
+        with self.lock:
+            self.lists[key].append(str(value))
+
+    def pop(self, key, count):
+        with self.lock:
+            values = self.lists.pop(key, [])
+            if values[count:]:
+                self.lists[key] = values[count:]
+            return values[:count]
+
+    def add_members(self, key, members, timeout=None):
+        with self.lock:
+            members = {str(member) for member in members}
+            added = members - self.sets[key]
+            self.sets[key].update(members)
+            return added, set(self.sets[key])
+
+    def get_sorted(self, key):
+        """ элементы ключа по убыванию рейтинга """
+        return sorted(self.zsets.get(key, {}).items(), key=score_order, reverse=True)
+
+    def store(self, key, items):
+        """ запись рейтингов ключа, пустые ключи удаляются """
+        if items:
+            self.zsets[key] = dict(items)
+        else:
+            self.zsets.pop(key, None)
+
+    def increment(self, increments, max_size=None):
+        with self.lock:
+            for key, amounts in increments.items():
+                zset = self.zsets[key]
+                for member, amount in amounts.items():
+                    zset[str(member)] = zset.get(str(member), 0) + amount
+                if max_size:
+                    self.store(key, self.get_sorted(key)[:max_size])
+
+    def top(self, keys, count):
+        with self.lock:
+            return [[member for member, _ in self.get_sorted(key)[:count]] for key in keys]
+
+    def items(self, keys):
+        with self.lock:
+            return {key: self.get_sorted(key) for key in keys}
+
+    def merge(self, keys, exclude):
+        """ сумма рейтингов ключей без исключаемых элементов """
+        scores = Counter()
+        for key in keys:
+            scores.update(self.zsets.get(key, {}))
+        for member in exclude:
+            scores.pop(str(member), None)
+        return scores
+
+    def union_top(self, keys, exclude, count):
+        with self.lock:
+            scores = self.merge(keys, exclude)
+            return [member for member, _ in nlargest(count, scores.items(), key=score_order)]
+
+    def union_store(self, dest, keys, exclude, max_size, timeout=None):
+        with self.lock:
+            scores = self.merge(keys, exclude)
+            self.store(dest, nlargest(max_size, scores.items(), key=score_order))
+
+    def replace(self, items, timeout=None):
+        with self.lock:
+            for key, scores in items.items():
+                self.store(key, [(str(member), score) for member, score in scores])
+
+    def trim(self, keys, max_size):
+        with self.lock:
+            for key in keys:
+                self.store(key, self.get_sorted(key)[:max_size])
+
+    def scale(self, keys, factor, min_score):
+        with self.lock:
+            for key in keys:
+                self.store(key, [
+                    (member, score * factor) for member, score in self.get_sorted(key) if score * factor >= min_score
+                ])
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                for storage in (self.values, self.lists, self.sets, self.zsets):
+                    storage.pop(key, None)
+
+    def scan(self, pattern, batch_size=500):
+        with self.lock:
+            keys = [
+                key for storage in (self.values, self.lists, self.sets, self.zsets)
+                for key in storage if fnmatch.fnmatchcase(key, pattern)
+            ]
+        for start in range(0, len(keys), batch_size):
+            yield keys[start:start + batch_size]
+
+
+def score_order(item):
+    """ порядок элементов как в redis: по рейтингу, при равенстве - по элементу """
+    member, score = item
+    return score, member
+
+
+_backend = None
+
+
+def get_backend():
+    """ хранилище рекомендаций из настройки RECOMMENDER_BACKEND, создается при первом обращении """
+    global _backend
+    if _backend is None:
+        backend_class = import_string(settings.RECOMMENDER_BACKEND['BACKEND'])
+        _backend = backend_class(**settings.RECOMMENDER_BACKEND.get('OPTIONS', {}))
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """ сброс хранилища при изменении настроек (override_settings в тестах) """
+    global _backend
+    if setting == 'RECOMMENDER_BACKEND':
+        _backend = None
@@ -0,0 +1,27 @@
+import orjson
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Рендерер JSON на orjson для плоских списков: компактный UTF-8, даты и Decimal через кодировщик DRF,
+    экранирование U+2028/U+2029. Вывод совпадает с JSONRenderer, кроме записи float с экспонентой
+    (1e+16 вместо 1e16); данные, которые orjson не кодирует (целые вне 64 бит), отдаются JSONRenderer
+    """
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        indent = self.get_indent(accepted_media_type, renderer_context)
+        # отступы и ASCII-вывод остаются за стандартным рендерером
+        if indent or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            content = orjson.dumps(data, default=JSONEncoder().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        return content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -1,12 +1,25 @@
 from decimal import Decimal
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import models, transaction
 
 from rest_framework import serializers
 
+from .cards import get_product_cards, get_short_cards
 from .models import Category, Product, Address, Cart, Order
 from .recommender import Recommender
-from .tasks import order_created
+from .tasks import order_created, products_bought, user_products_bought
+
+
+class DynamicFieldsMixin:
+    """ Сериализатор с выбором полей: fields - набор оставляемых полей верхнего уровня """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
 
 
 class AddressReadUpdateDeleteSerializer(serializers.ModelSerializer):
@@ -34,28 +47,30 @@ class AddressAddSerializer(serializers.ModelSerializer):
         return Address.objects.create(**validated_data)
 
 
-class FilterCategoryListSerializer(serializers.ListSerializer):
-    """ Фильтр категорий, только родители """
+class CategoryTreeListSerializer(serializers.ListSerializer):
+    """ Сборка дерева категорий в памяти из плоского списка, полученного одним запросом """
     def to_representation(self, data):
-        data = data.filter(parent=None)
-        return super().to_representation(data)
-
-
-class RecursiveSerializer(serializers.Serializer):
-    """ Вывод рекурсивно потомков """
-    def to_representation(self, value):
-        serializer = self.parent.parent.__class__(value, context=self.context)
-        return serializer.data
+        nodes = super().to_representation(data)
+        nodes_by_id = {node['id']: node for node in nodes}
+        roots = []
+        for node in nodes:
+            parent = nodes_by_id.get(node['parent'])
+            (parent['children'] if parent else roots).append(node)
+        return roots
 
 
 class CategorySerializer(serializers.ModelSerializer):
     """ Сериализатор для вывода категорий """
-    children = RecursiveSerializer(many=True)
 
     class Meta:
-        list_serializer_class = FilterCategoryListSerializer
+        list_serializer_class = CategoryTreeListSerializer
         model = Category
-        fields = ("id", "name", "url", "sort_order", "parent", "children")
+        fields = ("id", "name", "url", "sort_order", "parent")
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['children'] = []
+        return data
 
 
 class CategoryListSerializer(serializers.ModelSerializer):
@@ -65,7 +80,7 @@ class CategoryListSerializer(serializers.ModelSerializer):
         fields = ("name", )
 
 
-class ProductForCategoryListSerializer(serializers.ModelSerializer):
+class ProductForCategoryListSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """ Сериализатор для просмотра товаров по категориям"""
 
     class Meta:
@@ -73,22 +88,104 @@ class ProductForCategoryListSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'price')
 
 
-class ProductDetailSerializer(serializers.ModelSerializer):
-    """ Сериализатор для просмотра отдельных товаров"""
+class FlatSerializer(serializers.BaseSerializer):
+    """
+    Сериализатор строк values() без создания экземпляров моделей и обхода полей ModelSerializer;
+    вывод совпадает с соответствующим ModelSerializer, fields - набор оставляемых полей
+    """
+    class Meta:
+        # поля ответа и поля values(), из которых они строятся
+        fields = ()
+        values = ()
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        self.output_fields = None if fields is None else [name for name in self.Meta.fields if name in fields]
+
+    def get_data(self, row):
+        raise NotImplementedError
+
+    def to_representation(self, row):
+        data = self.get_data(row)
+        if self.output_fields is None:
+            return data
+        return {name: data[name] for name in self.output_fields}
+
+
+class ProductForCategoryFlatSerializer(FlatSerializer):
+    """ Плоский сериализатор товаров по категориям (строки values())"""
+    price = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        fields = ('id', 'name', 'price')
+        values = ('id', 'name', 'price')
+
+    def get_data(self, row):
+        return {'id': row['id'], 'name': row['name'], 'price': self.price.to_representation(row['price'])}
+
+
+class ProductCardSerializer(serializers.ModelSerializer):
+    """ Сериализатор карточки товара для кэша карточек"""
     category = CategoryListSerializer(read_only=True, many=True)
     brand = serializers.SlugRelatedField(slug_field='name', read_only=True)
+
+    class Meta:
+        model = Product
+        fields = ('id', 'name', 'price', 'brand', 'category')
+
+
+class ProductDetailListSerializer(serializers.ListSerializer):
+    """ Вывод списка товаров: рекомендации для всей страницы разом и карточки одним запросом к кэшу """
+    def to_representation(self, data):
+        products = list(data.all() if isinstance(data, models.Manager) else data)
+        self.child.load_cards(products)
+        return super().to_representation(products)
+
+
+class ProductDetailSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    """ Сериализатор для просмотра отдельных товаров, бренд и категории берутся из карточки товара"""
+    recommended_count = 4
+    category = serializers.SerializerMethodField()
+    brand = serializers.SerializerMethodField()
     recommended = serializers.SerializerMethodField()
 
     class Meta:
+        list_serializer_class = ProductDetailListSerializer
         model = Product
         fields = ('id', 'category', 'brand', 'name', 'description', 'price', 'recommended')
 
+    def load_cards(self, products):
+        """ карточки товаров и рекомендованных к ним товаров одним запросом к кэшу """
+        product_ids = [product.id for product in products]
+        recommended = {}
+        if 'recommended' in self.fields:
+            recommended = Recommender().suggest_ids_for_many(product_ids, self.recommended_count)
+        card_ids = {id for ids in recommended.values() for id in ids}
+        if {'brand', 'category'}.intersection(self.fields):
+            card_ids.update(product_ids)
+        cards = get_product_cards(card_ids)
+        self.context['cards'] = cards
+        self.context['recommended'] = {
+            product_id: get_short_cards(ids, cards) for product_id, ids in recommended.items()
+        }
+
+    def to_representation(self, instance):
+        if 'cards' not in self.context:
+            self.load_cards([instance])
+        return super().to_representation(instance)
+
+    def get_category(self, obj):
+        """ категории товара"""
+        return self.context['cards'].get(obj.id, {}).get('category', [])
+
+    def get_brand(self, obj):
+        """ название бренда"""
+        return self.context['cards'].get(obj.id, {}).get('brand')
+
     def get_recommended(self, obj):
         """ получение рекомендуемых товаров"""
-        r = Recommender()
-        recommended_products = r.suggest_products_for([obj], 4)
-        serializer = ProductForCategoryListSerializer(recommended_products, many=True)
-        return serializer.data
+        return self.context['recommended'].get(obj.id, [])
 
 
 class CartCreateUpdateSerializer(serializers.ModelSerializer):
@@ -134,6 +231,29 @@ class CartReadSerializer(serializers.ModelSerializer):
         fields = ('id', 'product', 'quantity', 'sum', 'order')
 
 
+class CartReadFlatSerializer(FlatSerializer):
+    """ Плоский сериализатор корзины (строки values())"""
+    price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    sum = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        fields = ('id', 'product', 'quantity', 'sum', 'order')
+        values = ('id', 'product_id', 'product__name', 'product__price', 'quantity', 'sum', 'order')
+
+    def get_data(self, row):
+        return {
+            'id': row['id'],
+            'product': {
+                'id': row['product_id'],
+                'name': row['product__name'],
+                'price': self.price.to_representation(row['product__price']),
+            },
+            'quantity': row['quantity'],
+            'sum': self.sum.to_representation(row['sum']),
+            'order': row['order'],
+        }
+
+
 class OrderCreateSerializer(serializers.ModelSerializer):
     """ Сериализатор для создания заказа"""
 
@@ -143,17 +263,21 @@ class OrderCreateSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         order = Order.objects.create(**validated_data)
-        r = Recommender()
-        products = []
+        product_ids = []
         for cart in Cart.objects.select_related('product', 'customer').filter(
                 customer=validated_data.get('customer'), order__isnull=True
         ):
-            products.append(cart.product)
+            product_ids.append(cart.product_id)
             cart.order = order
             cart.save()
         user_id = order.customer.pk
         order_created.delay(order.pk, user_id)
-        r.products_bought(products)
+        # рейтинги рекомендаций обновляются вне запроса, после коммита заказа
+        if settings.RECOMMENDER_COALESCE_PURCHASES:
+            transaction.on_commit(lambda: Recommender().queue_purchases(product_ids))
+        else:
+            transaction.on_commit(lambda: products_bought.delay(product_ids))
+        transaction.on_commit(lambda: user_products_bought.delay(user_id, product_ids))
         return order
 
 
@@ -1,55 +1,465 @@
+import base64
+import hashlib
+import json
+import uuid
+
 from decimal import Decimal
 
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
-from django.db.models import ExpressionWrapper, F, DecimalField, Sum
+from django.conf import settings
+from django_redis import get_redis_connection
+from django.core.cache import cache
+from django.core.paginator import Paginator as DjangoPaginator
+from django.db import DatabaseError, connections, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.db.models import BooleanField, Count, Expression, ExpressionWrapper, F, DecimalField, FloatField, \
+    Prefetch, Q, Sum, Value
+from django.db.models.functions import Cast
 from django.contrib.postgres.search import SearchVector, SearchRank, SearchQuery
 
-from .models import Product, Cart
+from .lookups import TrigramWordSimilarity
+from .models import Brand, Category, Product, Cart
+
+# конфигурация полнотекстового поиска postgres
+SEARCH_CONFIG = 'russian'
+
+# ключ версии дерева категорий в кэше
+CATEGORY_TREE_VERSION_KEY = 'category_tree:version'
+# версия кэша результатов поиска и счетчики популярности запросов
+SEARCH_VERSION_KEY = 'search:version'
+SEARCH_HITS_KEY = 'search:hits'
+
+
+class KeysetCondition(Expression):
+    """ Сравнение кортежей (поле, id) > (значение, id): диапазонный проход по составному индексу """
+
+    def __init__(self, fields, values, operator):
+        super().__init__(output_field=BooleanField())
+        self.fields = [F(field) for field in fields]
+        self.values = [Value(value) for value in values]
+        self.operator = operator
+
+    def get_source_expressions(self):
+        return self.fields + self.values
+
+    def set_source_expressions(self, exprs):
+        self.fields, self.values = exprs[:len(self.fields)], exprs[len(self.fields):]
+
+    def as_sql(self, compiler, connection):
+        sql_parts, params = [], []
+        for expression in self.get_source_expressions():
+            sql, expression_params = compiler.compile(expression)
+            sql_parts.append(sql)
+            params.extend(expression_params)
+        size = len(self.fields)
+        return '((%s) %s (%s))' % (
+            ', '.join(sql_parts[:size]), self.operator, ', '.join(sql_parts[size:])
+        ), params
+
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинатор по ключу (курсору): вместо OFFSET и COUNT(*) страница выбирается условием
+    (поле сортировки, id) > (значения последней строки), при равенстве поля порядок задает id
+    """
+    page_size = 20
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    page_query_param = 'page'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_keyset(self, queryset):
+        """ поля ключа и направление по сортировке выборки (OrderingFilter или order_by) """
+        ordering = [field for field in queryset.query.order_by if isinstance(field, str)]
+        field = ordering[0] if ordering else 'id'
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        fields = ['id'] if field in ('id', 'pk') else [field, 'id']
+        return fields, descending
+
+    def decode_cursor(self, request):
+        """ значения ключа и признак движения назад из параметра cursor; пустой курсор - первая страница """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return list(cursor['v']), bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound('Неверный курсор')
+
+    def encode_cursor(self, row, reverse):
+        values = [row[field] if isinstance(row, dict) else getattr(row, field) for field in self.fields]
+        cursor = json.dumps({'v': values, 'r': reverse}, default=str, separators=(',', ':'))
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, base64.urlsafe_b64encode(cursor.encode()).decode())
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        self.fields, descending = self.get_keyset(queryset)
+        values, reverse = self.decode_cursor(request)
+        # при движении назад выборка идет в обратном порядке и затем разворачивается
+        scan_descending = descending != reverse
+        if values is not None:
+            if len(values) != len(self.fields):
+                raise NotFound('Неверный курсор')
+            queryset = queryset.filter(KeysetCondition(self.fields, values, '<' if scan_descending else '>'))
+        queryset = queryset.order_by(*[('-' if scan_descending else '') + field for field in self.fields])
+        rows = list(queryset[:page_size + 1])
+        has_more = len(rows) > page_size
+        self.page = rows[:page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, values is not None
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'links': {
+                'next': self.get_next_link(),
+                'previous': self.get_previous_link()
+            },
+            'data': data
+        })
+
+
+class CountPaginator(DjangoPaginator):
+    """
+    Пагинатор с настраиваемым подсчетом: точный COUNT до порога PAGINATION_EXACT_COUNT_LIMIT,
+    выше порога - оценка планировщика postgres (estimate) или точное значение из кэша (cached)
+    """
+    count_is_approximate = False
+
+    def get_count_cache_key(self, queryset, mode):
+        digest = hashlib.md5(str(queryset.query).encode()).hexdigest()
+        return f'count:{mode}:{digest}'
+
+    def get_estimated_count(self, queryset):
+        """ оценка кол-ва строк планировщиком по EXPLAIN """
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    @cached_property
+    def count(self):
+        mode = settings.PAGINATION_COUNT_MODE
+        queryset = self.object_list
+        if mode == 'exact' or not isinstance(queryset, QuerySet):
+            return super().count
+        limit = settings.PAGINATION_EXACT_COUNT_LIMIT
+        queryset = queryset.order_by()
+        # ограниченный подсчет: COUNT по подзапросу с LIMIT не проходит всю выборку
+        count = queryset[:limit + 1].count()
+        if count <= limit:
+            return count
+        cache_key = self.get_count_cache_key(queryset, mode)
+        count = cache.get(cache_key)
+        if count is None:
+            if mode == 'estimate':
+                count = max(self.get_estimated_count(queryset), limit + 1)
+            else:
+                count = queryset.count()
+            cache.set(cache_key, count, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+        self.count_is_approximate = True
+        return count
 
 
 class Pagination(PageNumberPagination):
     """ Пагинатор"""
+    django_paginator_class = CountPaginator
     page_size = 20
     max_page_size = 200
     page_size_query_param = 'page_size'
+    # пагинатор по ключу, включается параметром ?cursor= (пустым для первой страницы)
+    keyset_pagination_class = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.keyset_pagination_class and self.keyset_pagination_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_pagination_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
 
     def get_paginated_response(self, data):
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
         return Response({
             'links': {
                 'next': self.get_next_link(),
                 'previous': self.get_previous_link()
             },
             'count': self.page.paginator.count,
+            'count_is_approximate': self.page.paginator.count_is_approximate,
             'data': data
         })
 
 
 class PaginationProductForCategory(Pagination):
-    pass
+    keyset_pagination_class = KeysetPagination
 
 
 class PaginationSearch(Pagination):
-    pass
+    keyset_pagination_class = KeysetPagination
 
 
 def product_search(query_params):
-    """ Улучшенный поиск с помощью расширения postgres"""
+    """ Улучшенный поиск по сохраненному поисковому вектору (GIN индекс)"""
     if query_params:
-        search_vector = SearchVector('name', weight='A') +\
-                        SearchVector('brand__name', weight='B') +\
-                        SearchVector('category__name', weight='B') + \
-                        SearchVector('category__parent__name', weight='C')
-        search_query = SearchQuery(query_params)
-        results = Product.objects.select_related('brand').prefetch_related('category').annotate(
-            rank=SearchRank(search_vector, search_query)
-        ).filter(rank__gte=0.1).order_by('-rank')
+        search_query = SearchQuery(query_params, config=SEARCH_CONFIG)
+        results = Product.objects.filter(
+            search_vector=search_query
+        ).annotate(
+            # ts_rank возвращает real: приводим к double, чтобы значение в курсоре совпадало со столбцом
+            rank=Cast(SearchRank(F('search_vector'), search_query), FloatField())
+        ).filter(rank__gte=0.1).order_by('-rank', 'id')
     else:
-        results = Product.objects.select_related('brand').prefetch_related('category').all()
+        results = Product.objects.all()
     return results
 
 
+def normalize_search_query(text):
+    """ нормализация поискового запроса: нижний регистр, уникальные слова по алфавиту"""
+    return ' '.join(sorted(set((text or '').lower().split())))
+
+
+def normalize_query_params(query_params, ignored_params=()):
+    """ параметры запроса в виде отсортированного списка пар без служебных и пустых значений"""
+    return sorted(
+        (key, value) for key, values in query_params.lists() if key not in ignored_params
+        for value in sorted(values) if value != ''
+    )
+
+
+def get_cached_search_ids(query, params, get_ids):
+    """
+    ранжированный список id найденных товаров из кэша, get_ids() вызывается только при промахе,
+    None - результатов больше SEARCH_CACHE_MAX_RESULTS, такой поиск не кэшируется
+    """
+    digest = hashlib.md5(json.dumps([query, params]).encode()).hexdigest()
+    cache_key = f'search:{get_version(SEARCH_VERSION_KEY)}:{digest}'
+    ids = cache.get(cache_key)
+    if ids is None:
+        limit = settings.SEARCH_CACHE_MAX_RESULTS
+        ids = list(get_ids()[:limit + 1])
+        if len(ids) > limit:
+            ids = False
+        cache.set(cache_key, ids, settings.SEARCH_CACHE_TIMEOUT)
+    return None if ids is False else ids
+
+
+def count_search_hit(query):
+    """ счетчик обращений к поисковому запросу в sorted set redis"""
+    try:
+        client = get_redis_connection('default')
+    except NotImplementedError:
+        return
+    client.zincrby(SEARCH_HITS_KEY, 1, query)
+
+
+def get_popular_searches(count):
+    """ самые частые поисковые запросы со счетчиками обращений"""
+    try:
+        client = get_redis_connection('default')
+    except NotImplementedError:
+        return []
+    return [
+        (query.decode(), int(hits)) for query, hits in client.zrevrange(SEARCH_HITS_KEY, 0, count - 1, withscores=True)
+    ]
+
+
+def trim_search_hits(count):
+    """ сохранение счетчиков только для count самых частых запросов"""
+    try:
+        client = get_redis_connection('default')
+    except NotImplementedError:
+        return
+    client.zremrangebyrank(SEARCH_HITS_KEY, 0, -count - 1)
+
+
+def prewarm_search_cache(count):
+    """ заполнение кэша результатов для самых частых поисковых запросов"""
+    queries = [query for query, hits in get_popular_searches(count)]
+    for query in queries:
+        get_cached_search_ids(query, [], lambda: product_search(query).values_list('pk', flat=True))
+    return queries
+
+
+def autocomplete_names(model, query, limit):
+    """ названия, похожие на строку ввода с учетом опечаток, по убыванию сходства"""
+    return list(
+        model.objects.filter(name__trigram_word_similar=query).annotate(
+            similarity=TrigramWordSimilarity('name', Value(query))
+        ).order_by('-similarity', 'id').values('id', 'name')[:limit]
+    )
+
+
+def product_autocomplete(query):
+    """
+    подсказки по названиям товаров и брендов для набора текста, запросы ограничены statement_timeout,
+    при превышении возвращается пустой результат
+    """
+    query = ' '.join((query or '').lower().split())
+    if len(query) < settings.AUTOCOMPLETE_MIN_LENGTH:
+        return {'products': [], 'brands': []}
+    cache_key = 'autocomplete:' + hashlib.md5(query.encode()).hexdigest()
+    result = cache.get(cache_key)
+    if result is not None:
+        return result
+    limit = settings.AUTOCOMPLETE_LIMIT
+    try:
+        with transaction.atomic(), connections['default'].cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s', [settings.AUTOCOMPLETE_STATEMENT_TIMEOUT])
+            result = {
+                'products': autocomplete_names(Product, query, limit),
+                'brands': autocomplete_names(Brand, query, limit),
+            }
+            # SET LOCAL живет до конца внешней транзакции, если она есть
+            cursor.execute('SET LOCAL statement_timeout = DEFAULT')
+    except DatabaseError:
+        return {'products': [], 'brands': []}
+    cache.set(cache_key, result, settings.AUTOCOMPLETE_CACHE_TIMEOUT)
+    return result
+
+
+def get_category_products(category_id, subtree=False):
+    """
+    товары категории; в режиме subtree - товары категории и всех ее потомков:
+    поиск по префиксу материализованного пути через полусоединение, без дублей и DISTINCT
+    """
+    products = Product.objects.all()
+    if not subtree:
+        return products.filter(category__id=category_id)
+    path = Category.objects.filter(pk=category_id).values_list('path', flat=True).first()
+    if path is None:
+        return products.none()
+    if not path:
+        # пути еще не заполнены (rebuild_category_tree): пустой префикс совпал бы со всеми категориями
+        return products.filter(category__id=category_id)
+    return products.filter(pk__in=Product.category.through.objects.filter(
+        category__path__startswith=path
+    ).values('product_id'))
+
+
+def get_facets(queryset):
+    """
+    фасеты выборки товаров: бренды и ценовые диапазоны одним запросом с группировкой по бренду
+    и условными счетчиками диапазонов, категории - вторым запросом по связи товар-категория
+    """
+    product_ids = queryset.order_by().values('pk')
+    bounds = settings.FACET_PRICE_BUCKETS
+    buckets = list(zip(bounds, bounds[1:] + [None]))
+    price_counts = {
+        f'price_{index}': Count('pk', filter=Q(price__gte=low, price__lt=high) if high else Q(price__gte=low))
+        for index, (low, high) in enumerate(buckets)
+    }
+    brand_rows = Product.objects.filter(pk__in=product_ids).values('brand_id', 'brand__name').annotate(
+        count=Count('pk'), **price_counts
+    ).order_by('-count', 'brand__name')
+    brands = []
+    prices = [0] * len(buckets)
+    for row in brand_rows:
+        if row['brand_id'] is not None:
+            brands.append({'id': row['brand_id'], 'name': row['brand__name'], 'count': row['count']})
+        for index in range(len(buckets)):
+            prices[index] += row[f'price_{index}']
+    categories = Product.category.through.objects.filter(product_id__in=product_ids).values(
+        'category_id', 'category__name'
+    ).annotate(count=Count('product_id')).order_by('-count', 'category__name')
+    return {
+        'brands': brands,
+        'categories': [
+            {'id': row['category_id'], 'name': row['category__name'], 'count': row['count']} for row in categories
+        ],
+        'price': [
+            {'from': low, 'to': high, 'count': count} for (low, high), count in zip(buckets, prices)
+        ],
+    }
+
+
+def get_cached_facets(queryset, path, query_params, ignored_params=()):
+    """ фасеты из кэша с коротким временем жизни, ключ - путь и нормализованные параметры фильтрации """
+    params = normalize_query_params(query_params, ignored_params)
+    digest = hashlib.md5(json.dumps([path, params]).encode()).hexdigest()
+    cache_key = f'facets:{digest}'
+    facets = cache.get(cache_key)
+    if facets is None:
+        facets = get_facets(queryset)
+        cache.set(cache_key, facets, settings.FACET_CACHE_TIMEOUT)
+    return facets
+
+
+def bump_search_version():
+    """ сброс закэшированных результатов поиска после коммита, иначе под новой версией закэшируется старая выдача """
+    transaction.on_commit(lambda: bump_version(SEARCH_VERSION_KEY))
+
+
+def update_search_vector(product_ids):
+    """ пересчет сохраненного поискового вектора товаров, закэшированные результаты поиска сбрасываются """
+    products = Product.objects.filter(pk__in=product_ids).select_related('brand').prefetch_related(
+        Prefetch('category', queryset=Category.objects.select_related('parent'))
+    )
+    for product in products:
+        categories = product.category.all()
+        brand_name = product.brand.name if product.brand else ''
+        category_names = ' '.join(category.name for category in categories)
+        parent_names = ' '.join(category.parent.name for category in categories if category.parent)
+        search_vector = SearchVector('name', weight='A', config=SEARCH_CONFIG) + \
+            SearchVector(Value(brand_name), weight='B', config=SEARCH_CONFIG) + \
+            SearchVector(Value(category_names), weight='B', config=SEARCH_CONFIG) + \
+            SearchVector(Value(parent_names), weight='C', config=SEARCH_CONFIG)
+        # update() не вызывает сигналы, поэтому рекурсии post_save нет
+        Product.objects.filter(pk=product.pk).update(search_vector=search_vector)
+    bump_search_version()
+
+
+def touch_products(product_ids):
+    """ обновление отметки изменения товаров (id или подзапрос) без сигналов сохранения """
+    Product.objects.filter(pk__in=product_ids).update(updated_at=timezone.now())
+
+
+def touch_categories(category_ids):
+    """ обновление отметки изменения категорий (id или подзапрос) и всех их предков по материализованному пути """
+    paths = Category.objects.filter(pk__in=category_ids).values_list('path', flat=True)
+    ancestor_ids = {int(pk) for path in paths for pk in path.split('/') if pk}
+    if ancestor_ids:
+        Category.objects.filter(pk__in=ancestor_ids).update(updated_at=timezone.now())
+
+
+def touch_product_categories(product_ids):
+    """ обновление отметки изменения категорий, в которые входят товары """
+    touch_categories(Product.category.through.objects.filter(product_id__in=product_ids).values('category_id'))
+
+
 def get_product_sum(user):
     """ размер стоимости по каждой товарной позиции (цена * кол-во) """
     return Cart.objects.filter(customer=user, order__isnull=True).select_related('product').annotate(
@@ -66,3 +476,37 @@ def get_products_total_sum(user):
 def get_sale(coupon, total_sum):
     """ размер скидки"""
     return (coupon.discount / Decimal('100')) * total_sum
+
+
+def get_version(key):
+    """ текущая версия группы закэшированных данных """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    """ смена версии: все данные, закэшированные под прежней версией, становятся неактуальными """
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def get_category_tree_version():
+    """ текущая версия дерева категорий, меняется при любом изменении категорий """
+    return get_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def bump_category_tree_version():
+    """ смена версии дерева категорий: закэшированные ответы и ETag становятся неактуальными """
+    bump_version(CATEGORY_TREE_VERSION_KEY)
+
+
+def get_category_tree_content(version, render):
+    """ готовый ответ с деревом категорий из кэша, render() вызывается только при промахе """
+    cache_key = f'category_tree:{version}'
+    content = cache.get(cache_key)
+    if content is None:
+        content = render()
+        cache.set(cache_key, content, settings.CATEGORY_TREE_CACHE_TIMEOUT)
+    return content
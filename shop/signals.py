@@ -0,0 +1,154 @@
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_migrate
+from django.dispatch import receiver
+
+from coupons.models import Coupon
+from .cards import bump_product_cards_version, delete_product_cards
+from .changes import record_change
+from .models import Brand, Category, Product
+from .service import bump_category_tree_version, bump_search_version, touch_categories, touch_product_categories, \
+    touch_products, update_search_vector
+from .tasks import refresh_search_vector
+
+
+# модель -> (общие теги, префикс тега объекта) событий изменений для сброса локальных кэшей
+CHANGE_TAGS = {
+    Product: (('products', ), 'product'),
+    Brand: (('products', ), 'brand'),
+    Category: (('categories', 'products'), 'category'),
+    Coupon: (('coupons', ), 'coupon'),
+}
+
+
+def schedule_search_vector_refresh(product_ids):
+    """ отложенный пересчет поискового вектора после коммита транзакции """
+    product_ids = list(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: refresh_search_vector.delay(product_ids))
+
+
+@receiver(pre_migrate)
+def create_trigram_extension(sender, using, **kwargs):
+    """ расширение pg_trgm для триграммных индексов названий до применения миграций """
+    if sender.name != 'shop' or connections[using].vendor != 'postgresql':
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    """ пересчет поискового вектора при сохранении товара """
+    update_search_vector([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_card_changed(sender, instance, **kwargs):
+    """ сброс карточки измененного или удаленного товара после коммита, иначе закэшируется прежняя карточка """
+    product_id = instance.pk
+    transaction.on_commit(lambda: delete_product_cards([product_id]))
+
+
+@receiver(post_save, sender=Product)
+@receiver(pre_delete, sender=Product)
+def product_touched(sender, instance, **kwargs):
+    """ отметка изменения категорий товара (до удаления, пока связь с категориями существует) """
+    touch_product_categories([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.category.through)
+def product_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    пересчет поискового вектора, сброс карточек и отметка изменения товаров и категорий
+    при изменении категорий товара
+    """
+    if action == 'pre_clear':
+        # после очистки связи уже не найти связанные объекты, запоминаем их заранее
+        related = instance.products if reverse else instance.category
+        instance._cleared_ids = list(related.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related_ids = getattr(instance, '_cleared_ids', []) if action == 'post_clear' else list(pk_set)
+    if reverse:
+        product_ids, category_ids = related_ids, [instance.pk]
+    else:
+        product_ids, category_ids = [instance.pk], related_ids
+    update_search_vector(product_ids)
+    transaction.on_commit(lambda: delete_product_cards(product_ids))
+    touch_products(product_ids)
+    touch_categories(category_ids)
+    record_change(
+        ['products', 'categories'] + [f'product:{pk}' for pk in product_ids] +
+        [f'category:{pk}' for pk in category_ids]
+    )
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, **kwargs):
+    """ сброс закэшированных результатов поиска при удалении товара """
+    bump_search_version()
+
+
+@receiver(post_save, sender=Brand)
+def brand_saved(sender, instance, created, **kwargs):
+    """ пересчет поискового вектора и отметка изменения товаров бренда и их категорий (фасеты брендов) при переименовании """
+    if not created:
+        schedule_search_vector_refresh(instance.product_set.values_list('pk', flat=True))
+        touch_products(instance.product_set.values('pk'))
+        touch_product_categories(instance.product_set.values('pk'))
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    """
+    пересчет поискового вектора товаров категории и ее потомков при переименовании,
+    отметка изменения товаров категории
+    """
+    if not created:
+        touch_products(instance.products.values('pk'))
+        schedule_search_vector_refresh(
+            Product.objects.filter(
+                Q(category=instance) | Q(category__parent=instance)
+            ).distinct().values_list('pk', flat=True)
+        )
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    """ отметка изменения товаров удаляемой категории и ее предков """
+    touch_products(instance.products.values('pk'))
+    if instance.parent_id:
+        touch_categories([instance.parent_id])
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def product_cards_names_changed(sender, created=False, **kwargs):
+    """ сброс всех карточек товаров при переименовании бренда, изменении или удалении категории """
+    if not created:
+        transaction.on_commit(bump_product_cards_version)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_tree_changed(sender, **kwargs):
+    """ сброс закэшированного дерева категорий после коммита, иначе под новой версией закэшируется старое дерево """
+    transaction.on_commit(bump_category_tree_version)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Coupon)
+def catalog_changed(sender, instance, **kwargs):
+    """ событие изменения в outbox в транзакции изменения """
+    tags, prefix = CHANGE_TAGS[sender]
+    record_change(list(tags) + [f'{prefix}:{instance.pk}'])
@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
+from django.core.management import call_command
 
 from online_store.celery import app
 
@@ -7,6 +8,11 @@ from django.conf import settings
 
 from online_store.settings import EMAIL_HOST_USER
 
+from . import changes
+from .cart import persist_dirty_carts
+from .recommender import Recommender
+from .service import prewarm_search_cache, trim_search_hits, update_search_vector
+
 User = get_user_model()
 
 @app.task
@@ -22,3 +28,74 @@ def order_created(order_id, user_id):
                           [EMAIL_HOST_USER],
                           fail_silently=False)
     return mail_sent
+
+
+@app.task
+def refresh_search_vector(product_ids):
+    """Пересчет поискового вектора товаров после переименования бренда или категории"""
+    update_search_vector(product_ids)
+
+
+@app.task
+def products_bought(product_ids):
+    """Обновление рейтингов рекомендаций после оформления заказа"""
+    Recommender().products_bought(product_ids)
+
+
+@app.task
+def flush_purchases():
+    """Пакетная запись накопленных заказов в рейтинги рекомендаций"""
+    recommender = Recommender()
+    batch_size = settings.RECOMMENDER_FLUSH_BATCH_SIZE
+    while recommender.flush_purchases(batch_size) == batch_size:
+        pass
+
+
+@app.task
+def trim_purchases():
+    """Ограничение размера рекомендаций каждого товара"""
+    Recommender().trim_purchases()
+
+
+@app.task
+def rebuild_recommendations():
+    """Пересчет рекомендаций по всей истории заказов"""
+    call_command('rebuild_recommendations')
+
+
+@app.task
+def rescale_purchases():
+    """Применение затухания к рейтингам рекомендаций"""
+    Recommender().rescale_purchases()
+
+
+@app.task
+def user_products_bought(user_id, product_ids):
+    """Обновление персональных рекомендаций пользователя после оформления заказа"""
+    Recommender().user_products_bought(user_id, product_ids)
+
+
+@app.task
+def prewarm_search():
+    """Заполнение кэша результатов популярных поисковых запросов"""
+    trim_search_hits(settings.SEARCH_STATS_MAX_QUERIES)
+    prewarm_search_cache(settings.SEARCH_PREWARM_QUERIES)
+
+
+@app.task
+def publish_changes():
+    """Публикация событий изменений каталога для сброса кэшей узлов"""
+    changes.publish_changes(settings.CHANGE_PUBLISH_BATCH_SIZE)
+
+
+@app.task
+def sweep_changes():
+    """Публикация событий, оставшихся неопубликованными, и удаление старых событий"""
+    changes.publish_changes(settings.CHANGE_PUBLISH_BATCH_SIZE)
+    changes.delete_published_changes()
+
+
+@app.task
+def persist_carts():
+    """Отложенная запись измененных корзин из redis в БД"""
+    persist_dirty_carts(settings.CART_PERSIST_BATCH_SIZE)
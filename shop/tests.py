@@ -1,21 +1,49 @@
+import gzip
+import json
+import os
+import tempfile
 from datetime import timedelta
+from io import StringIO
 
 from decimal import Decimal
 
+import numpy as np
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
 
 from coupons.models import Coupon
-from .models import Brand, Cart, Category, Product, Address, Order
+from .models import Brand, Cart, Category, ChangeEvent, Product, Address, Order
+from .cards import get_product_cards
+from .cart import RedisCart
+from .management.commands.rebuild_recommendations import Command as RebuildRecommendationsCommand
+from .recommender import Recommender
+from .recommender.backends import MemoryBackend
+from .renderers import ORJSONRenderer
+from .serializers import CartReadFlatSerializer, CartReadSerializer, ProductForCategoryFlatSerializer, \
+    ProductForCategoryListSerializer
+from .service import get_popular_searches, get_product_sum
 
 
 class ShopTests(APITestCase):
 
+    def run_commit_hooks(self):
+        """ выполнение действий, отложенных до коммита: транзакция TestCase не фиксируется """
+        connection = connections[DEFAULT_DB_ALIAS]
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for savepoint_ids, callback in callbacks:
+            callback()
+
     def setUp(self) -> None:
         brand1 = Brand.objects.create(name='6 соток')
         brand1.save()
@@ -78,6 +106,8 @@ class ShopTests(APITestCase):
             discount=20,
             active=True,
         )
+        # данные теста считаются зафиксированными: версии кэшей сбрасываются, как после коммита
+        self.run_commit_hooks()
 
     def test_addresses_list(self):
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
@@ -163,15 +193,95 @@ class ShopTests(APITestCase):
     def test_categories_list(self):
         response = self.client.get(reverse('categories_list'), format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(len(response.data[0]['children']), 2)
-        self.assertEqual(len(response.data[0]['children'][0]['children']), 1)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(len(response.json()[0]['children']), 2)
+        self.assertEqual(len(response.json()[0]['children'][0]['children']), 1)
+
+    def test_categories_list_not_modified(self):
+        response = self.client.get(reverse('categories_list'), format='json')
+        response_cached = self.client.get(reverse('categories_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_cached.status_code, status.HTTP_304_NOT_MODIFIED)
+        Category.objects.create(name='Фрукты', sort_order=1, url='frukti')
+        response_uncommitted = self.client.get(reverse('categories_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_uncommitted.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.run_commit_hooks()
+        response_changed = self.client.get(reverse('categories_list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_changed.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response_changed.json()), 2)
+
+    def test_product_detail_not_modified(self):
+        url = reverse('product_detail', kwargs={'pk': self.product2.pk})
+        response = self.client.get(url, format='json')
+        self.assertIn('public', response['Cache-Control'])
+        response_cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_cached.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.product2.brand.name = 'Синяя цена'
+        self.product2.brand.save()
+        response_changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_changed.status_code, status.HTTP_200_OK)
+
+    def test_category_products_not_modified(self):
+        url = reverse('product_for_category', kwargs={'pk': self.category4.parent_id}) + '?subtree=1'
+        response = self.client.get(url, format='json')
+        response_cached = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_cached.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.product3.price = Decimal('30')
+        self.product3.save()
+        response_changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_changed.status_code, status.HTTP_200_OK)
+
+    def test_category_facets_brand_renamed(self):
+        url = reverse('product_for_category', kwargs={'pk': self.category4.pk}) + '?facets=1'
+        response = self.client.get(url, format='json')
+        self.product2.brand.name = 'Синяя цена'
+        self.product2.brand.save()
+        response_changed = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response_changed.status_code, status.HTTP_200_OK)
+
+    def test_change_events_recorded(self):
+        ChangeEvent.objects.all().delete()
+        self.product2.price = Decimal('50')
+        self.product2.save()
+        category1 = Category.objects.get(url='ovoshi')
+        self.product2.category.add(category1)
+        tags = {tag for event in ChangeEvent.objects.all() for tag in event.tags}
+        self.assertTrue({'products', f'product:{self.product2.pk}', f'category:{category1.pk}'} <= tags)
+        self.assertFalse(ChangeEvent.objects.filter(published_at__isnull=False).exists())
+
+    def test_category_move(self):
+        category2 = Category.objects.get(url='ogurez')
+        category3 = Category.objects.get(url='ogurez_karlikovii')
+        self.assertEqual(category3.path, f'{category2.parent_id}/{category2.pk}/{category3.pk}/')
+        category2.parent = self.category4
+        category2.save()
+        category3.refresh_from_db()
+        self.assertEqual(category3.depth, 3)
+        self.assertEqual(category3.path, f'{self.category4.path}{category2.pk}/{category3.pk}/')
+        with self.assertRaises(ValueError):
+            self.category4.parent = category3
+            self.category4.save()
 
     def test_product_detail(self):
         response = self.client.get(reverse('product_detail', kwargs={'pk': self.product1.pk}), format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual((self.product1.pk, 'Огерец "6 соток" свежий'), (response.data['id'], response.data['name']))
 
+    def test_product_detail_recommended_order(self):
+        cache.clear()
+        recommender = Recommender()
+        recommender.clear_purchases()
+        recommender.add_pairs({(self.product1.pk, self.product2.pk): 1, (self.product1.pk, self.product3.pk): 5})
+        response = self.client.get(reverse('product_detail', kwargs={'pk': self.product1.pk}), format='json')
+        self.assertEqual(
+            [self.product3.pk, self.product2.pk],
+            [product['id'] for product in response.data['recommended']]
+        )
+        response_search = self.client.get(reverse('search') + '?search=огерец', format='json')
+        self.assertEqual(
+            [self.product3.pk, self.product2.pk],
+            [product['id'] for product in response_search.data['data'][0]['recommended']]
+        )
+
     def test_failure_product_detail(self):
         response = self.client.get(reverse('product_detail', kwargs={'pk': 777}), format='json')
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -185,6 +295,64 @@ class ShopTests(APITestCase):
             (response.data['data'][0]['name'], response.data['data'][1]['name'])
         )
 
+    def test_product_to_category_subtree(self):
+        category1 = Category.objects.get(url='ovoshi')
+        response = self.client.get(reverse('product_for_category', kwargs={'pk': category1.pk}), format='json')
+        self.assertEqual(response.data['count'], 0)
+        self.product2.category.add(category1)
+        response_subtree = self.client.get(
+            reverse('product_for_category', kwargs={'pk': category1.pk}) + '?subtree=1', format='json'
+        )
+        self.assertEqual(response_subtree.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_subtree.data['count'], 3)
+
+    def test_product_to_category_subtree_without_path(self):
+        # пути категорий до запуска rebuild_category_tree пусты
+        Category.objects.update(path='')
+        response = self.client.get(
+            reverse('product_for_category', kwargs={'pk': self.category4.pk}) + '?subtree=1', format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], self.category4.products.count())
+
+    @override_settings(PAGINATION_COUNT_MODE='estimate', PAGINATION_EXACT_COUNT_LIMIT=1)
+    def test_product_to_category_estimated_count(self):
+        response = self.client.get(reverse('product_for_category', kwargs={'pk': self.category4.pk}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['count_is_approximate'])
+        self.assertGreaterEqual(response.data['count'], 2)
+        category3 = Category.objects.get(url='ogurez_karlikovii')
+        response_exact = self.client.get(reverse('product_for_category', kwargs={'pk': category3.pk}), format='json')
+        self.assertFalse(response_exact.data['count_is_approximate'])
+
+    def test_product_to_category_cursor(self):
+        url = reverse('product_for_category', kwargs={'pk': self.category4.pk})
+        response = self.client.get(url + '?cursor=&page_size=1&ordering=-price', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        self.assertEqual([self.product2.pk], [product['id'] for product in response.data['data']])
+        self.assertIsNone(response.data['links']['previous'])
+        response_next = self.client.get(response.data['links']['next'], format='json')
+        self.assertEqual([self.product3.pk], [product['id'] for product in response_next.data['data']])
+        self.assertIsNone(response_next.data['links']['next'])
+        response_previous = self.client.get(response_next.data['links']['previous'], format='json')
+        self.assertEqual([self.product2.pk], [product['id'] for product in response_previous.data['data']])
+
+    def test_search_cursor_tied_ranks(self):
+        # одинаковые названия дают одинаковый, не двоичный ранг; каждый товар должен встретиться ровно один раз
+        products = [Product.objects.create(name='Редис свежий хрустящий', price=Decimal('10')) for _ in range(3)]
+        Product.objects.create(name='Редис', price=Decimal('12'))
+        url = reverse('search') + '?search=редис&cursor=&page_size=1'
+        seen = []
+        while url and len(seen) < 10:
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(product['id'] for product in response.data['data'])
+            url = response.data['links']['next']
+        self.assertEqual(4, len(seen))
+        self.assertEqual(4, len(set(seen)))
+        self.assertTrue({product.pk for product in products} <= set(seen))
+
     def test_failure_product_to_category(self):
         response = self.client.get(reverse('product_for_category', kwargs={'pk': 777}), format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -201,6 +369,124 @@ class ShopTests(APITestCase):
         self.assertEqual(response_small_cucumber.status_code, status.HTTP_200_OK)
         self.assertEqual(response_small_cucumber.data['count'], 1)
 
+    def test_search_facets(self):
+        cache.clear()
+        response = self.client.get(reverse('search') + '?search=помидор&facets=1', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        facets = response.data['facets']
+        self.assertEqual(sorted(brand['count'] for brand in facets['brands']), [1, 1])
+        self.assertEqual(
+            [{'id': self.category4.pk, 'name': 'Помидор', 'count': 2}], facets['categories']
+        )
+        self.assertEqual({'from': 0, 'to': 100, 'count': 2}, facets['price'][0])
+
+    def test_search_filter_price_and_brand(self):
+        url = reverse('search')
+        response = self.client.get(url + '?search=помидор&max_price=30', format='json')
+        self.assertEqual([self.product3.pk], [product['id'] for product in response.data['data']])
+        brand_id = self.product2.brand_id
+        response = self.client.get(url + f'?search=помидор&brand={brand_id}&min_price=40', format='json')
+        self.assertEqual([self.product2.pk], [product['id'] for product in response.data['data']])
+
+    def test_autocomplete_with_typo(self):
+        cache.clear()
+        response = self.client.get(reverse('autocomplete') + '?q=помидр', format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            {self.product2.pk, self.product3.pk}, {product['id'] for product in response.data['products']}
+        )
+        response = self.client.get(reverse('autocomplete') + '?q=по', format='json')
+        self.assertEqual({'products': [], 'brands': []}, response.data)
+
+    def test_search_results_cached(self):
+        cache.clear()
+        url = reverse('search')
+        response = self.client.get(url + '?search=Помидор', format='json')
+        self.assertEqual(2, response.data['count'])
+        response = self.client.get(url + '?search=помидор  ПОМИДОР', format='json')
+        self.assertEqual(
+            [self.product2.pk, self.product3.pk], sorted(product['id'] for product in response.data['data'])
+        )
+        self.product1.name = 'Огурец помидорный'
+        self.product1.save()
+        self.run_commit_hooks()
+        response = self.client.get(url + '?search=помидор', format='json')
+        self.assertEqual(3, response.data['count'])
+
+    def test_search_hits_first_page(self):
+        cache.clear()
+        url = reverse('search')
+        self.client.get(url + '?search=Помидор&page_size=1', format='json')
+        self.client.get(url + '?search=помидор&page_size=1&page=2', format='json')
+        self.client.get(url + '?search=помидор&cursor=', format='json')
+        self.assertEqual([('помидор', 2)], get_popular_searches(10))
+
+    def test_search_sparse_fields(self):
+        response = self.client.get(reverse('search') + '?search=помидор&fields=id,name', format='json')
+        self.assertEqual({'id', 'name'}, set(response.data['data'][0]))
+        response = self.client.get(
+            reverse('product_detail', kwargs={'pk': self.product2.pk}) + '?fields=id,price&expand=recommended',
+            format='json'
+        )
+        self.assertEqual({'id', 'price', 'recommended'}, set(response.data))
+
+    def test_flat_serializers_match(self):
+        products = Product.objects.order_by('id')
+        self.assertEqual(
+            JSONRenderer().render(ProductForCategoryListSerializer(products, many=True).data),
+            ORJSONRenderer().render(ProductForCategoryFlatSerializer(
+                products.values(*ProductForCategoryFlatSerializer.Meta.values), many=True
+            ).data)
+        )
+        carts = get_product_sum(self.cart.customer)
+        self.assertEqual(
+            JSONRenderer().render(CartReadSerializer(carts, many=True).data),
+            ORJSONRenderer().render(CartReadFlatSerializer(
+                carts.values(*CartReadFlatSerializer.Meta.values), many=True
+            ).data)
+        )
+
+    def test_product_cards_invalidated(self):
+        cache.clear()
+        url = reverse('product_detail', kwargs={'pk': self.product2.pk})
+        response = self.client.get(url, format='json')
+        self.assertEqual('Красная цена', response.data['brand'])
+        self.assertEqual([{'name': 'Помидор'}], response.data['category'])
+        self.product2.brand.name = 'Синяя цена'
+        self.product2.brand.save()
+        self.category4.name = 'Томат'
+        self.category4.save()
+        self.run_commit_hooks()
+        response = self.client.get(url, format='json')
+        self.assertEqual('Синяя цена', response.data['brand'])
+        self.assertEqual([{'name': 'Томат'}], response.data['category'])
+        self.product2.category.clear()
+        self.run_commit_hooks()
+        response = self.client.get(url, format='json')
+        self.assertEqual([], response.data['category'])
+
+    def test_product_card_not_cached_before_commit(self):
+        cache.clear()
+        card = get_product_cards([self.product2.pk])[self.product2.pk]
+        self.product2.brand.name = 'Синяя цена'
+        self.product2.brand.save()
+        self.product2.price = Decimal('50')
+        self.product2.save()
+        # до коммита в кэше остается прежняя карточка, сброс выполняется только после коммита
+        self.assertEqual(card, get_product_cards([self.product2.pk])[self.product2.pk])
+        self.run_commit_hooks()
+        card = get_product_cards([self.product2.pk])[self.product2.pk]
+        self.assertEqual('Синяя цена', card['brand'])
+        self.assertEqual(Decimal('50'), Decimal(card['price']))
+
+    def test_search_vector_updated(self):
+        response_brand = self.client.get(reverse('search') + '?search=соток', format='json')
+        self.assertEqual(response_brand.data['count'], 2)
+        self.product2.name = 'Помидор "Красная цена" маринованный'
+        self.product2.save()
+        response_pickled = self.client.get(reverse('search') + '?search=маринованный', format='json')
+        self.assertEqual(response_pickled.data['count'], 1)
+
     def test_fail_search(self):
         response_vegetables = self.client.get(reverse('search') + '?search=fdbdfbdfb', format='json')
         self.assertEqual(response_vegetables.status_code, status.HTTP_200_OK)
@@ -251,6 +537,34 @@ class ShopTests(APITestCase):
         response = self.client.post(reverse('cart_update', kwargs={'pk': cart_pk}), {'quantity': 'dfgdfg'}, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_cart_recommended(self):
+        cache.clear()
+        recommender = Recommender()
+        recommender.clear_purchases()
+        recommender.add_pairs({(self.product1.pk, self.product2.pk): 1, (self.product1.pk, self.product3.pk): 3})
+        Cart.objects.create(customer=self.cart.customer, product=self.product2, quantity=1)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
+        response = self.client.get(reverse('cart_recommended'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([self.product3.pk], [product['id'] for product in response.data])
+
+    def test_user_recommended(self):
+        recommender = Recommender()
+        recommender.clear_purchases()
+        recommender.add_pairs({(self.product1.pk, self.product2.pk): 1, (self.product1.pk, self.product3.pk): 3})
+        self.cart.order = self.order
+        self.cart.save()
+        recommender.rebuild_user_suggestions(self.cart.customer_id)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
+        response = self.client.get(reverse('user_recommended'), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([self.product3.pk, self.product2.pk], [product['id'] for product in response.data])
+        # повторная покупка того же товара не увеличивает рейтинги
+        user_key = recommender.get_user_key(self.cart.customer_id)
+        scores = recommender.backend.items([user_key])
+        recommender.user_products_bought(self.cart.customer_id, [self.product1.pk])
+        self.assertEqual(scores, recommender.backend.items([user_key]))
+
     def test_short_cart(self):
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
         response = self.client.get(reverse('short_cart'), format='json')
@@ -258,6 +572,62 @@ class ShopTests(APITestCase):
         self.assertEqual(response.data['count'], 2)
         self.assertEqual(response.data['final_cost'], Decimal('70.00'))
 
+    @override_settings(CART_STORAGE='redis')
+    def test_redis_cart(self):
+        user = self.cart.customer
+        RedisCart(user.pk).reset()
+        # пустой хеш заполняется открытыми строками Cart, запись в БД их не удаляет
+        self.assertEqual({self.product1.pk: 2}, RedisCart(user.pk).persist())
+        self.assertTrue(Cart.objects.filter(pk=self.cart.pk, quantity=2).exists())
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
+        for product in (self.product1, self.product2, self.product2):
+            response = self.client.post(reverse('product_add_to_cart', kwargs={'pk': product.pk}), format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['quantity'], 2)
+        response = self.client.post(
+            reverse('cart_update', kwargs={'pk': self.product1.pk}), {'quantity': 3}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('cart_list'), format='json')
+        self.assertEqual(
+            [(self.product1.pk, 3, '105.00'), (self.product2.pk, 2, '90.00')],
+            [(line['id'], line['quantity'], line['sum']) for line in response.json()]
+        )
+        response = self.client.get(reverse('short_cart'), format='json')
+        self.assertEqual(response.data['final_cost'], Decimal('195.00'))
+        response = self.client.post(reverse('order_add'), {'address': self.address1.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(order.price, Decimal('195.00'))
+        self.assertEqual(
+            {self.product1.pk: 3, self.product2.pk: 2}, dict(order.items.values_list('product_id', 'quantity'))
+        )
+        self.run_commit_hooks()
+        self.assertEqual({}, RedisCart(user.pk).items())
+
+    @override_settings(CART_STORAGE='redis')
+    def test_redis_cart_last_item_removed(self):
+        cart = RedisCart(self.cart.customer_id)
+        cart.reset()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
+        response = self.client.delete(reverse('cart_delete', kwargs={'pk': self.product1.pk}), format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        # опустевшая корзина не загружается из БД повторно
+        response = self.client.get(reverse('cart_list'), format='json')
+        self.assertEqual([], response.json())
+        self.assertEqual({}, cart.persist())
+        self.assertFalse(Cart.objects.filter(pk=self.cart.pk).exists())
+
+    @override_settings(CART_STORAGE='redis')
+    def test_redis_cart_release_keeps_added(self):
+        cart = RedisCart(self.cart.customer_id)
+        cart.reset()
+        persisted = cart.persist()
+        cart.add(self.product1.pk)
+        cart.add(self.product2.pk)
+        cart.release(persisted)
+        self.assertEqual({self.product1.pk: 1, self.product2.pk: 1}, cart.items())
+
     def test_add_order(self):
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user_test1_token.key)
         response = self.client.post(
@@ -284,3 +654,153 @@ class ShopTests(APITestCase):
         self.assertEqual(order.json()[0].get('discount'), 20)
         self.assertEqual(Decimal(order.json()[0].get('price')), self.product1.price*2*Decimal('0.8'))
 
+
+
+class RecommenderTests(APITestCase):
+
+    def test_count_pairs(self):
+        pairs = Recommender().count_pairs([[1, 2, 3], [1, 2], [2, 2]])
+        self.assertEqual(pairs[(1, 2)], 2)
+        self.assertEqual(pairs[(2, 1)], 2)
+        self.assertEqual(pairs[(3, 1)], 1)
+        self.assertNotIn((2, 2), pairs)
+        self.assertEqual(len(pairs), 6)
+
+    @override_settings(RECOMMENDER_MAX_SUGGESTIONS=2)
+    def test_trim_on_write(self):
+        cache.clear()
+        recommender = Recommender()
+        recommender.clear_purchases()
+        recommender.add_pairs({(1, 2): 1, (1, 3): 3, (1, 4): 2, (1, 5): 4, (1, 6): 5})
+        self.assertEqual([6, 5, 3, 4], recommender.suggest_ids_for_many([1], 5)[1])
+        recommender.trim_purchases()
+        cache.clear()
+        self.assertEqual([6, 5], recommender.suggest_ids_for_many([1], 5)[1])
+        recommender.clear_purchases()
+        self.assertEqual([], list(recommender.scan_product_keys()))
+
+    @override_settings(RECOMMENDER_DECAY_HALF_LIFE_DAYS=1)
+    def test_decay_weight(self):
+        recommender = Recommender()
+        epoch = recommender.get_decay_epoch()
+        self.assertAlmostEqual(recommender.get_weight(epoch), 1)
+        self.assertAlmostEqual(recommender.get_weight(epoch + 24 * 60 * 60), 2)
+        self.assertAlmostEqual(recommender.get_weight(epoch - 2 * 24 * 60 * 60), 0.25)
+
+
+class ORJSONRendererTests(SimpleTestCase):
+
+    def test_output_matches_json_renderer(self):
+        data = {
+            'name': 'Помидор "6 соток"\u2028', 'price': Decimal('28.50'), 'count': 2, 'ids': [1, None, True],
+            'created': timezone.now(), 1: 'ключ',
+        }
+        self.assertEqual(JSONRenderer().render(data), ORJSONRenderer().render(data))
+
+    def test_unsupported_values_fall_back(self):
+        data = {'id': 2 ** 70, 'ids': [-2 ** 64]}
+        self.assertEqual(JSONRenderer().render(data), ORJSONRenderer().render(data))
+
+
+class MemoryBackendTests(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.recommender = Recommender(MemoryBackend())
+
+    def test_increment_and_top(self):
+        self.recommender.add_pairs(self.recommender.count_pairs([[1, 2, 3], [1, 3], [1, 4]]))
+        self.assertEqual([['3', '4', '2'], ['3', '1']], self.recommender.backend.top(
+            [self.recommender.get_product_key(1), self.recommender.get_product_key(2)], 5
+        ))
+
+    def test_union_top(self):
+        self.recommender.add_pairs(self.recommender.count_pairs([[1, 2, 3], [1, 3], [2, 4], [2, 4]]))
+        keys = [self.recommender.get_product_key(1), self.recommender.get_product_key(2)]
+        self.assertEqual(['3', '4'], self.recommender.backend.union_top(keys, [1, 2], 5))
+
+    def test_add_members(self):
+        self.assertEqual(({'1', '2'}, {'1', '2'}), self.recommender.backend.add_members('purchased', [1, 2]))
+        self.assertEqual(({'3'}, {'1', '2', '3'}), self.recommender.backend.add_members('purchased', [2, 3]))
+
+    @override_settings(RECOMMENDER_MAX_SUGGESTIONS=2, RECOMMENDER_TRIM_ON_WRITE=True, RECOMMENDER_TRIM_SLACK=2)
+    def test_new_partner_overtakes_when_full(self):
+        key = self.recommender.get_product_key(1)
+        self.recommender.add_pairs({(1, 2): 2, (1, 3): 2})
+        for i in range(3):
+            self.recommender.add_pairs({(1, 4): 1})
+        self.assertEqual(['4'], self.recommender.backend.top([key], 1)[0])
+        self.recommender.trim_purchases()
+        self.assertEqual(2, len(self.recommender.backend.items([key])[key]))
+
+    def test_pending_queue(self):
+        self.recommender.queue_purchases([7, 8])
+        self.recommender.queue_purchases([7, 9])
+        self.assertEqual(1, self.recommender.flush_purchases(1))
+        self.assertEqual(1, self.recommender.flush_purchases(5))
+        self.assertEqual(0, self.recommender.flush_purchases(5))
+
+
+class RebuildRecommendationsTests(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.command = RebuildRecommendationsCommand()
+
+    def test_count_pairs(self):
+        # заказ 1: товары 1, 2 и повтор товара 2; заказ 2: товары 1, 3; товар 9 вне матрицы
+        order_ids = np.array([1, 1, 1, 2, 2, 2])
+        product_ids = np.array([1, 2, 2, 1, 3, 9])
+        pairs = self.command.count_pairs(order_ids, product_ids, 4).toarray()
+        self.assertEqual(1, pairs[1, 2])
+        self.assertEqual(1, pairs[2, 1])
+        self.assertEqual(1, pairs[1, 3])
+        self.assertEqual(0, pairs[2, 3])
+        self.assertFalse(pairs.diagonal().any())
+        weighted = self.command.count_pairs(order_ids, product_ids, 4, np.array([2., 2., 2., 0.5, 0.5, 0.5]))
+        self.assertEqual(2, weighted[1, 2])
+        self.assertEqual(0.5, weighted[3, 1])
+
+    def test_load_top_from_checkpoint(self):
+        recommender = Recommender(MemoryBackend())
+        recommender.replace_purchases({7: [(1, 1.0)]})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'recommendations.npz')
+            first = self.command.count_pairs(np.array([1, 1, 2, 2]), np.array([1, 2, 1, 2]), 4)
+            self.command.save_checkpoint(path, first, 2)
+            # после сохранения появился товар 4, матрица расширяется
+            matrix, last_order_id = self.command.load_checkpoint(path, 5, False)
+            self.assertEqual((2, (5, 5)), (last_order_id, matrix.shape))
+            self.assertEqual(0, self.command.load_checkpoint(path, 5, True)[1])
+        matrix = matrix + self.command.count_pairs(np.array([3, 3, 3]), np.array([1, 3, 4]), 5)
+        self.assertEqual(4, self.command.load_top(matrix.tocsr(), 2, batch_size=2, recommender=recommender))
+        # товар 7 без покупок в матрице удаляется из хранилища
+        self.assertEqual(
+            [['2', '3'], ['1'], ['4', '1'], ['3', '1'], []],
+            recommender.backend.top([recommender.get_product_key(id) for id in (1, 2, 3, 4, 7)], 2)
+        )
+
+
+@override_settings(RECOMMENDER_BACKEND={'BACKEND': 'shop.recommender.backends.MemoryBackend'})
+class RecommendationSnapshotTests(SimpleTestCase):
+
+    def test_dump_and_load(self):
+        recommender = Recommender()
+        recommender.replace_purchases({1: [(2, 3.0), (3, 1.5)], 2: [(1, 3.0)]})
+        keys = [recommender.get_product_key(id) for id in (1, 2, 5)]
+        items = recommender.backend.items(keys)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'recommendations.gz')
+            call_command('dump_recommendations', path, stdout=StringIO())
+            recommender.clear_purchases()
+            recommender.replace_purchases({5: [(1, 1.0)]})
+            call_command('load_recommendations', path, '--batch-size', '1', stdout=StringIO())
+            self.assertEqual([('1', 1.0)], recommender.backend.items(keys)[keys[2]])
+            call_command('load_recommendations', path, '--clear', stdout=StringIO())
+        self.assertEqual(items, recommender.backend.items(keys))
+
+    def test_load_unknown_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'recommendations.gz')
+            with gzip.open(path, 'wt', encoding='utf-8') as snapshot:
+                snapshot.write(json.dumps({'format': 'recommendations/0'}) + '\n')
+            with self.assertRaises(CommandError):
+                call_command('load_recommendations', path, stdout=StringIO())
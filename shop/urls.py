@@ -3,7 +3,8 @@ from django.urls import path
 from rest_framework.urlpatterns import format_suffix_patterns
 
 from .views import AddressModelViewSet, CartModelViewSet, CategoryLIstViewSet, ProductDetailViewSet, \
-    ProductForCategoryViewSet, SearchView, ShortCartModelViewSet, OrderViewSet
+    ProductForCategoryViewSet, SearchView, ShortCartModelViewSet, OrderViewSet, CartRecommendedViewSet, \
+    UserRecommendedViewSet, AutocompleteView
 
 
 
@@ -18,9 +19,12 @@ urlpatterns = format_suffix_patterns([
     path('product/<int:pk>/add/', CartModelViewSet.as_view({'post': 'create'}), name='product_add_to_cart'),
     path('product/<int:pk>/', ProductDetailViewSet.as_view({'get': 'retrieve'}), name='product_detail'),
     path('search/', SearchView.as_view({'get': 'list'}), name='search'),
+    path('search/autocomplete/', AutocompleteView.as_view({'get': 'list'}), name='autocomplete'),
     path('cart/', CartModelViewSet.as_view({'get': 'list'}), name='cart_list'),
     path('cart/<int:pk>/update/', CartModelViewSet.as_view({'post': 'partial_update'}), name='cart_update'),
     path('cart/<int:pk>/delete/', CartModelViewSet.as_view({'delete': 'destroy'}), name='cart_delete'),
+    path('cart/recommended/', CartRecommendedViewSet.as_view({'get': 'list'}), name='cart_recommended'),
+    path('recommended/', UserRecommendedViewSet.as_view({'get': 'list'}), name='user_recommended'),
     path('short-cart/', ShortCartModelViewSet.as_view({'get': 'list'}), name='short_cart'),
     path('order/<int:pk>/', OrderViewSet.as_view({'get': 'retrieve'}), name='order_detail'),
     path('orders/', OrderViewSet.as_view({'get': 'list'}), name='order_list'),
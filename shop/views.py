@@ -1,9 +1,20 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 
-from rest_framework import permissions, filters
+from rest_framework import permissions, filters, status
 from rest_framework.viewsets import GenericViewSet, ModelViewSet, ViewSet
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
+from django_filters.rest_framework import DjangoFilterBackend
 
 from .serializers import (
     AddressReadUpdateDeleteSerializer,
@@ -11,14 +22,24 @@ from .serializers import (
     CategorySerializer,
     ProductDetailSerializer,
     ProductForCategoryListSerializer,
+    ProductForCategoryFlatSerializer,
     CartReadSerializer,
+    CartReadFlatSerializer,
     CartCreateUpdateSerializer,
     OrderReadSerializer,
     OrderCreateSerializer,
 )
 from .service import PaginationProductForCategory, PaginationSearch, product_search, get_product_sum, \
-    get_products_total_sum, get_sale
-from .models import Address, Category, Product, Order
+    get_products_total_sum, get_sale, get_category_tree_version, get_category_tree_content, \
+    get_category_products, get_cached_facets, product_autocomplete, \
+    normalize_search_query, normalize_query_params, get_cached_search_ids, count_search_hit, KeysetPagination
+from .cards import get_product_cards, get_short_cards
+from .cart import RedisCart, use_redis_cart
+from .changes import get_local_cached
+from .filters import ProductFilter
+from .renderers import ORJSONRenderer
+from .models import Address, Cart, Category, Product, Order
+from .recommender import Recommender
 
 from coupons.models import Coupon
 
@@ -40,51 +61,209 @@ class AddressModelViewSet(ModelViewSet):
         serializer.save(customer=self.request.user)
 
 
-class CategoryLIstViewSet(ListModelMixin, GenericViewSet):
-    """ Вывод списка категорий """
-    queryset = Category.objects.all().prefetch_related('children').order_by('-sort_order')
+class ConditionalGetMixin:
+    """
+    Условные запросы к каталогу: валидаторы (версия и время изменения) вычисляются до выборки
+    и сериализации, при совпадении ETag или If-Modified-Since ответ 304; Cache-Control для общих кэшей
+    """
+
+    def get_etag(self, request, version):
+        """ ETag по версии данных и полному адресу запроса (страница, фильтры, поля) """
+        return quote_etag(hashlib.md5(f'{version}:{request.get_full_path()}'.encode()).hexdigest())
+
+    def conditional_response(self, request, version, last_modified, get_response):
+        etag = self.get_etag(request, version)
+        last_modified = last_modified and int(last_modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = get_response()
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True, max_age=settings.CATALOG_CACHE_MAX_AGE)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class CategoryLIstViewSet(ConditionalGetMixin, ListModelMixin, GenericViewSet):
+    """ Вывод дерева категорий из кэша с поддержкой условных запросов (ETag) """
+    queryset = Category.objects.all().order_by('-sort_order', 'id')
     serializer_class = CategorySerializer
 
+    def get_etag(self, request, version):
+        return quote_etag(version)
 
-class ProductDetailViewSet(RetrieveModelMixin, GenericViewSet):
-    """ Просмотр отдельного товара """
-    serializer_class = ProductDetailSerializer
-    queryset = Product.objects.all().select_related('brand').prefetch_related('category')
+    def list(self, request, *args, **kwargs):
+        # версия и готовый ответ держатся в локальном кэше узла до события изменения категорий
+        version = get_local_cached('category_tree:version', ['categories'], get_category_tree_version)
+
+        def get_response():
+            content = get_local_cached(f'category_tree:{version}', ['categories'], lambda: get_category_tree_content(
+                version, lambda: ORJSONRenderer().render(self.get_serializer(self.get_queryset(), many=True).data)
+            ))
+            return HttpResponse(content, content_type='application/json')
+
+        return self.conditional_response(request, version, None, get_response)
+
+
+class FacetsMixin:
+    """ Добавление фасетов фильтра (?facets=1) к ответу списка товаров """
+    facets_ignored_params = ('page', 'page_size', 'cursor', 'ordering', 'facets')
 
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        if request.query_params.get('facets') in ('1', 'true'):
+            response.data['facets'] = get_cached_facets(
+                self.filter_queryset(self.get_queryset()), request.path, request.query_params,
+                self.facets_ignored_params
+            )
+        return response
 
-class ProductForCategoryViewSet(ListModelMixin, GenericViewSet):
-    """ Просмотр всех товаров, принадлежащих к отдельной категории"""
+
+class SparseFieldsMixin:
+    """
+    Выбор полей товара параметрами ?fields=id,name и ?expand=recommended (добавляется к fields),
+    только для полей верхнего уровня; колонки неиспользуемых полей не загружаются
+    """
+    # поля ответа, загрузку колонок которых можно отложить
+    sparse_defer_fields = ('description', )
+
+    def get_requested_fields(self):
+        request = getattr(self, 'request', None)
+        fields = request.query_params.get('fields') if request else None
+        if not fields:
+            return None
+        expand = request.query_params.get('expand', '')
+        return {name.strip() for name in f'{fields},{expand}'.split(',') if name.strip()}
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs.setdefault('fields', fields)
+        return super().get_serializer(*args, **kwargs)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        fields = self.get_requested_fields()
+        if fields is None:
+            fields = set(self.get_serializer_class().Meta.fields)
+        deferred = [name for name in self.sparse_defer_fields if name not in fields]
+        if deferred:
+            queryset = queryset.defer(*deferred)
+        return queryset
+
+
+class FlatListMixin:
+    """ Список из строк values() с плоским сериализатором и рендерером orjson, без создания экземпляров моделей """
+    flat_serializer_class = None
+    renderer_classes = [ORJSONRenderer, BrowsableAPIRenderer]
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return self.flat_serializer_class
+        return super().get_serializer_class()
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.action != 'list':
+            return queryset
+        return queryset.values(*self.flat_serializer_class.Meta.values)
+
+
+class ProductDetailViewSet(ConditionalGetMixin, SparseFieldsMixin, RetrieveModelMixin, GenericViewSet):
+    """ Просмотр отдельного товара """
+    serializer_class = ProductDetailSerializer
+    queryset = Product.objects.all()
+
+    def retrieve(self, request, *args, **kwargs):
+        updated_at = Product.objects.filter(pk=kwargs['pk']).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return super().retrieve(request, *args, **kwargs)
+        # рекомендации меняются без изменения товара: версия включает интервал их кэширования
+        interval = settings.RECOMMENDER_CACHE_TIMEOUT
+        started = datetime.fromtimestamp(int(time.time()) // interval * interval, timezone.utc)
+        return self.conditional_response(
+            request, f'{updated_at.isoformat()}:{started.timestamp()}', max(updated_at, started),
+            lambda: super(ProductDetailViewSet, self).retrieve(request, *args, **kwargs)
+        )
+
+
+class ProductForCategoryViewSet(ConditionalGetMixin, FlatListMixin, SparseFieldsMixin, FacetsMixin, ListModelMixin,
+                                GenericViewSet):
+    """ Просмотр всех товаров, принадлежащих к отдельной категории (?subtree=1 - вместе с подкатегориями)"""
     serializer_class = ProductForCategoryListSerializer
+    flat_serializer_class = ProductForCategoryFlatSerializer
     pagination_class = PaginationProductForCategory
-    filter_backends = [filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_class = ProductFilter
     ordering_fields = ['id', 'name', 'price']
     ordering = ['id']
 
     def get_queryset(self):
-        return Product.objects.select_related('brand').prefetch_related('category').filter(
-            category__id=self.kwargs['pk'])
+        subtree = self.request.query_params.get('subtree') in ('1', 'true')
+        return get_category_products(self.kwargs['pk'], subtree)
+
+    def list(self, request, *args, **kwargs):
+        updated_at = Category.objects.filter(pk=kwargs['pk']).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return super().list(request, *args, **kwargs)
+        return self.conditional_response(
+            request, updated_at.isoformat(), updated_at,
+            lambda: super(ProductForCategoryViewSet, self).list(request, *args, **kwargs)
+        )
 
 
-class SearchView(ListModelMixin, GenericViewSet):
+class SearchView(SparseFieldsMixin, FacetsMixin, ListModelMixin, GenericViewSet):
     """ Поиск по товарам """
     serializer_class = ProductDetailSerializer
     pagination_class = PaginationSearch
+    filterset_class = ProductFilter
+    # параметры, не влияющие на список найденных товаров
+    search_ignored_params = ('search', 'page', 'page_size', 'cursor', 'facets')
 
     def get_queryset(self):
         query_params = self.request.query_params.get('search', None)
         results = product_search(query_params)
         return results
 
+    def paginate_queryset(self, queryset):
+        """ страница берется из закэшированного списка id, ранжирующий запрос выполняется только при промахе"""
+        query = normalize_search_query(self.request.query_params.get('search'))
+        if not query:
+            return super().paginate_queryset(queryset)
+        params = self.request.query_params
+        # популярность считается по первой странице, листание выдачи не добавляет обращений
+        if params.get(self.paginator.page_query_param, '1') == '1' and not params.get(KeysetPagination.cursor_query_param):
+            count_search_hit(query)
+        if KeysetPagination.cursor_query_param in params:
+            return super().paginate_queryset(queryset)
+        params = normalize_query_params(params, self.search_ignored_params)
+        ids = get_cached_search_ids(query, params, lambda: queryset.values_list('pk', flat=True))
+        if ids is None:
+            return super().paginate_queryset(queryset)
+        page_ids = super().paginate_queryset(ids)
+        products = queryset.filter(pk__in=page_ids).in_bulk()
+        return [products[pk] for pk in page_ids if pk in products]
+
+
+class AutocompleteView(ViewSet):
+    """ Подсказки по названиям товаров и брендов (?q=) """
+
+    def list(self, request):
+        return Response(product_autocomplete(request.query_params.get('q', '')))
+
 
-class CartModelViewSet(ModelViewSet):
+class CartModelViewSet(FlatListMixin, ModelViewSet):
     """ CRUD корзины """
     permission_classes = [permissions.IsAuthenticated]
+    serializer_class = CartReadSerializer
+    flat_serializer_class = CartReadFlatSerializer
 
     def get_serializer_class(self):
         if self.action == 'create' or self.action == 'partial_update':
             return CartCreateUpdateSerializer
         else:
-            return CartReadSerializer
+            return super().get_serializer_class()
 
     def get_queryset(self):
         return get_product_sum(self.request.user)
@@ -93,19 +272,77 @@ class CartModelViewSet(ModelViewSet):
         product = get_object_or_404(Product, pk=self.kwargs['pk'])
         serializer.save(customer=self.request.user, product=product)
 
+    # в режиме CART_STORAGE = 'redis' корзина читается и меняется в redis, pk позиции - id товара
+
+    def list(self, request, *args, **kwargs):
+        if use_redis_cart():
+            return Response(RedisCart(request.user.pk).lines())
+        return super().list(request, *args, **kwargs)
+
+    def create(self, request, *args, **kwargs):
+        if not use_redis_cart():
+            return super().create(request, *args, **kwargs)
+        if kwargs['pk'] not in get_product_cards([kwargs['pk']]):
+            raise Http404
+        return Response({'quantity': RedisCart(request.user.pk).add(kwargs['pk'])}, status=status.HTTP_201_CREATED)
+
+    def partial_update(self, request, *args, **kwargs):
+        if not use_redis_cart():
+            return super().partial_update(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        quantity = serializer.validated_data.get('quantity', 0)
+        if not RedisCart(request.user.pk).set(kwargs['pk'], quantity):
+            raise Http404
+        return Response({'quantity': quantity})
+
+    def destroy(self, request, *args, **kwargs):
+        if not use_redis_cart():
+            return super().destroy(request, *args, **kwargs)
+        if not RedisCart(request.user.pk).remove(kwargs['pk']):
+            raise Http404
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 class ShortCartModelViewSet(ViewSet):
     """ Просмтор краткой информации о  корзине """
     permission_classes = [permissions.IsAuthenticated]
 
     def list(self, request):
-        queryset = get_products_total_sum(self.request.user)
+        if use_redis_cart():
+            queryset = RedisCart(request.user.pk).total()
+        else:
+            queryset = get_products_total_sum(self.request.user)
         return Response({
             'final_cost': queryset['final_cost'],
             'count': queryset['count']
         })
 
 
+class CartRecommendedViewSet(ViewSet):
+    """ Товары, которые часто покупают вместе с товарами корзины """
+    permission_classes = [permissions.IsAuthenticated]
+    max_results = 6
+
+    def list(self, request):
+        if use_redis_cart():
+            product_ids = list(RedisCart(request.user.pk).items())
+        else:
+            product_ids = Cart.objects.filter(customer=request.user, order__isnull=True).values_list(
+                'product_id', flat=True
+            )
+        return Response(get_short_cards(Recommender().suggest_ids_for(product_ids, self.max_results)))
+
+
+class UserRecommendedViewSet(ViewSet):
+    """ Персональные рекомендации по истории заказов пользователя """
+    permission_classes = [permissions.IsAuthenticated]
+    max_results = 6
+
+    def list(self, request):
+        return Response(get_short_cards(Recommender().suggest_ids_for_user(request.user.pk, self.max_results)))
+
+
 class OrderViewSet(ModelViewSet):
     """
     Просмотр и добавление заказа
@@ -123,6 +360,11 @@ class OrderViewSet(ModelViewSet):
             return OrderReadSerializer
 
     def perform_create(self, serializer):
+        cart = None
+        if use_redis_cart():
+            # корзина из redis записывается в БД до расчета стоимости, заказ собирается из строк Cart
+            cart = RedisCart(self.request.user.pk)
+            persisted = cart.persist()
         total_sum = get_products_total_sum(self.request.user)['final_cost']
         coupon_id = self.request.session.get('coupon_id')
         try:
@@ -136,3 +378,6 @@ class OrderViewSet(ModelViewSet):
 
         order_id = serializer.data.get('id')
         self.request.session['order_id'] = order_id
+        if cart:
+            # оформленное кол-во убирается из redis только после сохранения заказа
+            transaction.on_commit(lambda: cart.release(persisted))